@@ -0,0 +1,163 @@
+"""
+Authorization for private rooms.
+
+Public rooms are open to every user; a private room only to its owner and
+members. The ids of the private rooms each user can enter are cached as one
+set, so checking a room is a single cache hit with no query for the room's
+owner or memberships. Every HTTP view, the media view and the WebSocket and
+long-poll consumers go through ``can_access_room``. ``room_for_slug`` caches
+the little of a room that check needs, so polls can be authorized before
+anything about the room's activity is revealed.
+
+The set is invalidated whenever it can change: a membership is created or
+deleted, or a room is created, deleted or changes type or owner (see
+``chatapp.signals``).
+
+Joining by access code is one lookup on the unique ``access_code`` index.
+Each user gets ``CHAT_JOIN_RATE_LIMIT`` lookups per minute so codes cannot be
+brute-forced, and codes that just missed are remembered in process for a
+short while, so repeated wrong guesses do not reach the database at all.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ChatRoom, PrivateRoomMembership
+
+ROOM_ACCESS_TIMEOUT = getattr(settings, 'CHAT_ROOM_ACCESS_TIMEOUT', 300)  # seconds
+JOIN_RATE_LIMIT = getattr(settings, 'CHAT_JOIN_RATE_LIMIT', 10)  # lookups per user per minute
+JOIN_RATE_WINDOW = 60  # seconds
+MISSING_CODE_TTL = getattr(settings, 'CHAT_MISSING_CODE_TTL', 60)  # seconds
+MISSING_CODE_MAX = 10000
+
+ACCESS_CODE_RE = re.compile(r'^[A-Z0-9]{1,20}$')
+
+
+def access_cache_key(user_id):
+    return 'chatapp:room-access:%s' % user_id
+
+
+def private_room_ids(user):
+    """Ids of the private rooms user owns or has joined"""
+    if not user.is_authenticated:
+        return frozenset()
+    key = access_cache_key(user.id)
+    room_ids = cache.get(key)
+    if room_ids is None:
+        owned = ChatRoom.objects.filter(owner_id=user.id, room_type='private').values_list('id', flat=True)
+        joined = PrivateRoomMembership.objects.filter(
+            user_id=user.id, room__room_type='private'
+        ).values_list('room_id', flat=True)
+        room_ids = frozenset(owned.union(joined))
+        cache.set(key, room_ids, ROOM_ACCESS_TIMEOUT)
+    return room_ids
+
+
+def room_cache_key(slug):
+    return 'chatapp:room:%s' % slug
+
+
+def room_for_slug(slug):
+    """The room with this slug or None, cached with only id, slug and room_type loaded"""
+    key = room_cache_key(slug)
+    room = cache.get(key)
+    if room is None:
+        room = ChatRoom.objects.only('id', 'slug', 'room_type').filter(slug=slug).first()
+        if room is None:
+            return None
+        cache.set(key, room, ROOM_ACCESS_TIMEOUT)
+    return room
+
+
+def can_access_room(user, room):
+    """Public rooms are open to everyone; private ones to the owner and members"""
+    if room.room_type != 'private':
+        return True
+    return room.id in private_room_ids(user)
+
+
+def accessible_rooms_filter(user, prefix=''):
+    """Q matching the rooms can_access_room() allows, for filtering querysets"""
+    return ~Q(**{f'{prefix}room_type': 'private'}) | Q(**{f'{prefix}id__in': private_room_ids(user)})
+
+
+def invalidate_room_access(*user_ids):
+    """Forget cached room access for users, now and again once the transaction commits"""
+    keys = [access_cache_key(user_id) for user_id in user_ids if user_id is not None]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    # A request that read the old rows before the commit may have cached them meanwhile
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_room(*slugs):
+    """Forget cached rooms by slug, now and again once the transaction commits"""
+    keys = [room_cache_key(slug) for slug in slugs if slug]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class MissingCodeCache:
+    """Small in-process LRU of access codes that matched no room, with a TTL"""
+
+    def __init__(self, ttl=MISSING_CODE_TTL, max_size=MISSING_CODE_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._codes = OrderedDict()
+
+    def __contains__(self, code):
+        with self._lock:
+            expires = self._codes.get(code)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._codes[code]
+                return False
+            return True
+
+    def add(self, code):
+        with self._lock:
+            self._codes[code] = time.monotonic() + self.ttl
+            self._codes.move_to_end(code)
+            while len(self._codes) > self.max_size:
+                self._codes.popitem(last=False)
+
+    def discard(self, code):
+        with self._lock:
+            self._codes.pop(code, None)
+
+
+missing_codes = MissingCodeCache()
+
+
+def join_rate_limited(user):
+    """Count a code lookup by user; True once they are over the limit for this minute"""
+    key = 'chatapp:join-attempts:%s:%d' % (user.id, time.time() // JOIN_RATE_WINDOW)
+    cache.add(key, 0, JOIN_RATE_WINDOW)
+    try:
+        attempts = cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.set(key, 1, JOIN_RATE_WINDOW)
+        attempts = 1
+    return attempts > JOIN_RATE_LIMIT
+
+
+def room_for_access_code(code):
+    """The private room with this access code, or None"""
+    if not ACCESS_CODE_RE.match(code) or code in missing_codes:
+        return None
+    room = ChatRoom.objects.filter(access_code=code, room_type='private').first()
+    if room is None:
+        missing_codes.add(code)
+    return room
@@ -4,7 +4,7 @@ from django.contrib.auth.admin import UserAdmin
 from django.utils import timezone
 from django.contrib import messages
 from django.utils.html import format_html
-from .models import ChatRoom, ChatMessage, MessageReaction, UserPresence, UserBlock
+from .models import Attachment, ChatRoom, ChatMessage, MessageReaction, MessageReactionCount, UserPresence, UserBlock
 
 
 # User Block Admin
@@ -36,9 +36,27 @@ class UserBlockAdmin(admin.ModelAdmin):
     is_currently_blocked.boolean = True
     is_currently_blocked.short_description = 'Currently Blocked'
     
+    def _update_blocks(self, queryset, **fields):
+        """Bulk update blocks, which skips UserBlock.save(), and clear the users' cached status
+
+        The users are collected first: a changelist filtered on a field being
+        updated matches nothing any more once the update has run.
+        """
+        user_ids = set(queryset.values_list('user_id', flat=True))
+        count = queryset.update(**fields)
+        for user_id in user_ids:
+            UserBlock.invalidate_block_cache(user_id)
+        return count
+    
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for user_id in user_ids:
+            UserBlock.invalidate_block_cache(user_id)
+    
     def unblock_users(self, request, queryset):
         """Custom action to unblock selected users"""
-        count = queryset.update(is_active=False)
+        count = self._update_blocks(queryset, is_active=False)
         self.message_user(request, f'Successfully unblocked {count} user(s).', messages.SUCCESS)
     unblock_users.short_description = "Unblock selected users"
     
@@ -72,7 +90,7 @@ class UserBlockAdmin(admin.ModelAdmin):
     
     def make_permanent(self, request, queryset):
         """Make blocks permanent"""
-        count = queryset.update(block_type='permanent', blocked_until=None)
+        count = self._update_blocks(queryset, block_type='permanent', blocked_until=None)
         self.message_user(request, f'Made {count} block(s) permanent.', messages.SUCCESS)
     make_permanent.short_description = "Make blocks permanent"
 
@@ -111,7 +129,7 @@ class CustomUserAdmin(UserAdmin):
             if user.is_superuser:
                 continue  # Don't block superusers
             # Deactivate existing blocks for this user
-            UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+            UserBlock.deactivate_user_blocks(user)
             # Create new block
             UserBlock.objects.create(
                 user=user,
@@ -131,7 +149,7 @@ class CustomUserAdmin(UserAdmin):
             if user.is_superuser:
                 continue  # Don't block superusers
             # Deactivate existing blocks for this user
-            UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+            UserBlock.deactivate_user_blocks(user)
             # Create new block
             UserBlock.objects.create(
                 user=user,
@@ -151,7 +169,7 @@ class CustomUserAdmin(UserAdmin):
             if user.is_superuser:
                 continue  # Don't block superusers
             # Deactivate existing blocks for this user
-            UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+            UserBlock.deactivate_user_blocks(user)
             # Create new permanent block
             UserBlock.objects.create(
                 user=user,
@@ -167,7 +185,7 @@ class CustomUserAdmin(UserAdmin):
         """Unblock selected users"""
         count = 0
         for user in queryset:
-            updated_count = UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+            updated_count = UserBlock.deactivate_user_blocks(user)
             if updated_count > 0:
                 count += 1
         self.message_user(request, f'Unblocked {count} user(s).', messages.SUCCESS)
@@ -182,4 +200,6 @@ admin.site.register(User, CustomUserAdmin)
 admin.site.register(ChatRoom)
 admin.site.register(ChatMessage)
 admin.site.register(MessageReaction)
+admin.site.register(MessageReactionCount)
 admin.site.register(UserPresence)
+admin.site.register(Attachment)
@@ -28,7 +28,7 @@ def block_user_form(request, user_id):
             return render(request, 'admin/chatapp/block_user_form.html', {'user': user})
         
         # Remove existing blocks for this user
-        UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+        UserBlock.deactivate_user_blocks(user)
         
         # Create new block based on type
         if block_type == 'permanent':
@@ -85,7 +85,7 @@ def quick_unblock_user(request, user_id):
     """Quick unblock user via AJAX"""
     user = get_object_or_404(User, id=user_id)
     
-    updated_count = UserBlock.objects.filter(user=user, is_active=True).update(is_active=False)
+    updated_count = UserBlock.deactivate_user_blocks(user)
     
     if updated_count > 0:
         messages.success(request, f'User {user.username} has been unblocked.')
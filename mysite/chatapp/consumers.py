@@ -1,13 +1,40 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.generic.http import AsyncHttpConsumer
 import json
-from asgiref.sync import sync_to_async
-from django.contrib.auth.models import User
-from .models import ChatRoom,ChatMessage
+import logging
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from .access import can_access_room
+from .models import ChatRoom, ChatMessage, MessageReaction
+from .pagination import MAX_PAGE_SIZE, clamp_page_size, delta_page
+from .persistence import message_buffer
+from .presence import presence_registry
+from .realtime import room_group_name, room_waiters
+
+logger = logging.getLogger(__name__)
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
     
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = 'chat_%s' % self.room_name
+        self.room_group_name = room_group_name(self.room_name)
+        
+        # Resolve who is connected and to which room once per socket;
+        # every message on this socket reuses them instead of trusting the payload
+        self.user = self.scope.get('user')
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.room = await self.get_room(self.room_name)
+        if self.room is None:
+            await self.close()
+            return
+        if not await database_sync_to_async(can_access_room)(self.user, self.room):
+            self.room = None
+            await self.close()
+            return
         
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -15,53 +42,151 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
+        
+        # Tell the new socket who else is here, then announce this user
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'action': 'roster',
+            'usernames': await presence_registry.online_usernames(self.room.id),
+        }))
+        await presence_registry.join(self.room, self.user, self.channel_name)
     
     async def disconnect(self, close_code):
+        if getattr(self, 'room', None) is None:
+            return
+        
+        await presence_registry.leave(self.room.id, self.channel_name)
+        
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
     async def receive(self, text_data):
-        print(f"Received data: {text_data}")  # Debug print
+        logger.debug('Received data: %s', text_data)
         data = json.loads(text_data)
-        message = data['message']
-        username = data['username']
-        room = data['room']
-        
-        print(f"Parsed - Message: {message}, Username: {username}, Room: {room}")  # Debug print
-        
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                'type': 'chat_message',
-                'message': message,
-                'username': username,
-                'room': room,
-            }
-        )
         
-        await self.save_message(username, room, message)
+        # Keep-alive from the page; sockets that stop pinging are expired
+        if data.get('type') == 'ping':
+            await presence_registry.touch(self.room, self.user, self.channel_name)
+            return
         
+        message = data.get('message', '')
+        username = data.get('username', self.user.username)
+        room = data.get('room', self.room.slug)
+        
+        logger.debug('Parsed - Message: %s, Username: %s, Room: %s', message, username, room)
+        
+        # Reject payloads that claim to come from someone else or another room
+        if username != self.user.username or room != self.room.slug:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'error': 'Message identity does not match this connection.',
+            }))
+            return
+        
+        if not message:
+            return
+        
+        # Saved in the next batch and broadcast to the room once committed,
+        # exactly as messages sent through views.send_message are delivered
+        await message_buffer.submit(self.user, self.room, message, self.channel_name)
+    
     async def chat_message(self, event):
         message = event['message']
-        username = event['username']
-        room = event['room']
         
-        print(f"Broadcasting message: {message} from {username} in {room}")  # Debug print
+        logger.debug('Broadcasting message %s from %s in %s', message['id'], message['username'], self.room_name)
         
         await self.send(text_data=json.dumps({
+            'type': 'message',
             'message': message,
-            'username': username,
-            'room': room,
         }))
     
-    @sync_to_async 
-    def save_message(self, username, room, message):
+    async def chat_error(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'error',
+            'error': event['error'],
+            'message': event['message'],
+        }))
+    
+    async def reaction_update(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'reactions',
+            'message_id': event['message_id'],
+            'counts': event['counts'],
+        }))
+    
+    async def presence_update(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'action': event['action'],
+            'username': event['username'],
+        }))
+    
+    @database_sync_to_async
+    def get_room(self, slug):
+        return ChatRoom.objects.filter(slug=slug).first()
+    
+
+
+class MessageLongPollConsumer(AsyncHttpConsumer):
+    """
+    Long-poll variant of views.get_messages for clients without a WebSocket.
+    
+    Routed in mysite.asgi ahead of Django so a parked request is just a
+    coroutine waiting on the room's channel group, not a worker thread.
+    """
+    
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.send_json(403, {'error': 'Authentication required.', 'messages': []})
+            return
+        
+        slug = self.scope['url_route']['kwargs']['slug']
+        params = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            user = User.objects.get(username=username)
-            room_obj = ChatRoom.objects.get(slug=room)
-            ChatMessage.objects.create(user=user, room=room_obj, message_content=message)
-            print(f"Message saved successfully: {message}")
-        except Exception as e:
-            print(f"Error saving message: {e}")
-    
\ No newline at end of file
+            last_message_id = int(params.get('last_message_id', ['0'])[0] or 0)
+        except ValueError:
+            await self.send_json(400, {'error': 'Invalid last_message_id', 'messages': []})
+            return
+        limit = clamp_page_size(params.get('limit', [None])[0], default=MAX_PAGE_SIZE)
+        
+        room = await self.get_room(slug)
+        if room is None:
+            await self.send_json(404, {'error': 'Room not found', 'messages': []})
+            return
+        if not await database_sync_to_async(can_access_room)(user, room):
+            await self.send_json(403, {'error': 'You do not have access to this room.', 'messages': []})
+            return
+        
+        # Park only while the room is idle; the wait returns as soon
+        # as a newer message is broadcast, or immediately if too many are parked
+        high_water = await ChatMessage.ahigh_water_mark(slug)
+        if high_water is None:
+            high_water = await database_sync_to_async(ChatMessage.refresh_high_water_mark)(room)
+        if high_water <= last_message_id:
+            await room_waiters.wait(room, last_message_id)
+        
+        await self.send_json(200, await self.get_delta(room, user, last_message_id, limit))
+    
+    async def send_json(self, status, data):
+        await self.send_response(status, json.dumps(data).encode(), headers=[
+            (b'Content-Type', b'application/json'),
+            (b'Cache-Control', b'no-store'),
+        ])
+    
+    @database_sync_to_async
+    def get_room(self, slug):
+        return ChatRoom.objects.filter(slug=slug).first()
+    
+    @database_sync_to_async
+    def get_delta(self, room, user, last_message_id, limit):
+        """Same payload as views.get_messages"""
+        rows, has_more = delta_page(ChatMessage.objects.filter(room=room), last_message_id, limit)
+        reactions = MessageReaction.summarize([row['id'] for row in rows], user)
+        return {
+            'messages': [ChatMessage.dict_from_values(row, reactions.get(row['id'])) for row in rows],
+            'has_more': has_more,
+            'last_message_id': rows[-1]['id'] if rows else last_message_id,
+        }
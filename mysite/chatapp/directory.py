@@ -0,0 +1,92 @@
+"""
+The public room directory shown on the landing page.
+
+Rooms are listed newest first, ``CHAT_DIRECTORY_PAGE_SIZE`` per page, each
+with its message count, last activity and how many users are online. Message
+counts and last activity are columns on ``ChatRoom`` that posting and
+deleting messages keep up to date, so nothing is aggregated per room. Each
+page is built once and cached for ``CHAT_DIRECTORY_TIMEOUT`` seconds, and
+every cached page is dropped at once when a room is created, edited or
+deleted, by bumping the version that is part of the cache keys.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import transaction
+
+from .models import ChatRoom, UserPresence
+
+DIRECTORY_PAGE_SIZE = getattr(settings, 'CHAT_DIRECTORY_PAGE_SIZE', 20)
+DIRECTORY_TIMEOUT = getattr(settings, 'CHAT_DIRECTORY_TIMEOUT', 30)  # seconds
+
+VERSION_KEY = 'chatapp:directory-version'
+
+
+def directory_version():
+    # Seeded from the clock so a lost version key never brings back older pages
+    return cache.get_or_set(VERSION_KEY, time.time_ns, None)
+
+
+def invalidate_directory():
+    """Drop every cached directory page, now and again once the transaction commits"""
+    def bump():
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, time.time_ns(), None)
+    bump()
+    transaction.on_commit(bump)
+
+
+def build_directory_page(number):
+    """One page of public rooms with their activity, straight from the database"""
+    rooms = (
+        ChatRoom.objects.filter(room_type='public')
+        .select_related('owner')
+        .only('id', 'name', 'slug', 'created_at', 'message_count', 'last_activity_at', 'owner__username')
+        .order_by('-created_at', '-id')
+    )
+    page = Paginator(rooms, DIRECTORY_PAGE_SIZE).get_page(number)
+    online = UserPresence.online_counts([room.id for room in page])
+
+    return {
+        'rooms': [{
+            'id': room.id,
+            'name': room.name,
+            'slug': room.slug,
+            'owner': room.owner.username,
+            'created_at': room.created_at,
+            'message_count': room.message_count,
+            'last_activity_at': room.last_activity_at,
+            'online_count': online.get(room.id, 0),
+        } for room in page],
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'count': page.paginator.count,
+        'has_previous': page.has_previous(),
+        'has_next': page.has_next(),
+    }
+
+
+def directory_page(number):
+    """A cached page of the directory; number may be anything from a query string"""
+    try:
+        number = max(int(number), 1)
+    except (TypeError, ValueError):
+        number = 1
+    version = directory_version()
+    # Clamp the way Paginator.get_page does, so out of range numbers share the last page's entry
+    num_pages = cache.get('chatapp:directory:%s:num_pages' % version)
+    if num_pages is not None:
+        number = min(number, num_pages)
+    key = 'chatapp:directory:%s:%d' % (version, number)
+    data = cache.get(key)
+    if data is None:
+        data = build_directory_page(number)
+        cache.set_many({
+            'chatapp:directory:%s:%d' % (version, data['page']): data,
+            'chatapp:directory:%s:num_pages' % version: data['num_pages'],
+        }, DIRECTORY_TIMEOUT)
+    return data
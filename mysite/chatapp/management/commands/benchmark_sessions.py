@@ -0,0 +1,97 @@
+"""
+Management command that measures session writes per chat request.
+
+A logged-in client polls ``get_messages`` and, every ``--presence-every``
+polls, pings ``update_presence``, the way an open room page does. The run is
+repeated for each session mode and counts the statements that write
+``django_session`` and the responses that send a new session cookie.
+
+Everything the benchmark creates is rolled back when it finishes.
+"""
+import re
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from chatapp.models import ChatMessage, ChatRoom
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+
+SESSION_WRITE_RE = re.compile(r'^\s*(INSERT|UPDATE|DELETE)\b.*\bdjango_session\b', re.IGNORECASE | re.DOTALL)
+
+
+class SessionWriteCounter:
+    """execute_wrapper counting the statements that write the session table"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if SESSION_WRITE_RE.match(sql):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Count session writes per poll and presence ping for each session mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300,
+                            help='Polls to send per mode (default: 300)')
+        parser.add_argument('--presence-every', type=int, default=15,
+                            help='Send a presence ping every N polls (default: 15, i.e. 30s of 2s polls)')
+        parser.add_argument('--modes', default=','.join(SESSION_ENGINES),
+                            help='Comma-separated session modes to compare (default: all)')
+
+    def handle(self, *args, **options):
+        modes = [mode.strip() for mode in options['modes'].split(',') if mode.strip()]
+        self.stdout.write(f'{"mode":<16}{"requests":>10}{"db writes":>11}{"cookies":>9}{"writes/req":>12}')
+        for mode in modes:
+            requests, writes, cookies = self.run_mode(mode, options['requests'], options['presence_every'])
+            self.stdout.write(f'{mode:<16}{requests:>10}{writes:>11}{cookies:>9}{writes / requests:>12.3f}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Current mode: {getattr(settings, "SESSION_MODE", "db")} '
+            f'(refresh interval {getattr(settings, "SESSION_REFRESH_INTERVAL", 0)}s)'
+        ))
+
+    def run_mode(self, mode, polls, presence_every):
+        """(requests sent, django_session writes, session cookies set) for one mode"""
+        overrides = {
+            'SESSION_ENGINE': SESSION_ENGINES[mode],
+            'SESSION_SAVE_EVERY_REQUEST': mode == 'db',
+            'ALLOWED_HOSTS': ['testserver'],
+        }
+        with override_settings(**overrides), transaction.atomic():
+            suffix = uuid.uuid4().hex[:8]
+            user = User.objects.create_user(f'session-bench-{suffix}')
+            room = ChatRoom.objects.create(name=f'Session bench {suffix}', slug=f'session-bench-{suffix}', owner=user)
+            message = ChatMessage.objects.create(user=user, room=room, message_content='benchmark')
+
+            client = Client()
+            client.force_login(user)
+            poll_url = reverse('get_messages', args=[room.slug])
+            presence_url = reverse('update_presence', args=[room.slug])
+
+            counter = SessionWriteCounter()
+            requests = cookies = 0
+            with connection.execute_wrapper(counter):
+                for number in range(1, polls + 1):
+                    responses = [client.get(poll_url, {'last_message_id': message.id})]
+                    if presence_every and number % presence_every == 0:
+                        responses.append(client.post(presence_url))
+                    for response in responses:
+                        requests += 1
+                        cookies += settings.SESSION_COOKIE_NAME in response.cookies
+
+            client.logout()
+            transaction.set_rollback(True)
+        return requests, counter.writes, cookies
@@ -0,0 +1,110 @@
+"""
+Management command that EXPLAINs the chat app's hot queries.
+
+Every query the views, models and admin dashboard run on each request or
+poll is planned against the configured database. The command fails if any
+of them would read a whole table instead of using an index, so a missing or
+dropped index shows up in CI or before a deploy rather than under load.
+
+On PostgreSQL sequential scans are disabled for the check, so small or empty
+tables do not hide a missing index behind a cheaper seq scan.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from chatapp.models import (
+    ChatMessage, ChatRoom, MessageReactionCount, PrivateRoomMembership, UserBlock, UserPresence
+)
+from chatapp.search import get_search_backend
+
+
+def hot_queries():
+    """(label, queryset) for every query on a hot path"""
+    now = timezone.now()
+    room = ChatRoom(id=1)
+    search = get_search_backend(connection.alias)
+    return [
+        ('chatroom: latest page of history',
+         ChatMessage.objects.filter(room=room).order_by('-created_at', '-id')[:31]),
+        ('message_history: page before a cursor',
+         ChatMessage.objects.filter(room=room).filter(
+             Q(created_at__lt=now) | Q(created_at=now, id__lt=1)
+         ).order_by('-created_at', '-id')[:31]),
+        ('get_messages: messages after the last seen id',
+         ChatMessage.objects.filter(room=room, id__gt=1).order_by('id')),
+        ('get_online_users',
+         UserPresence.get_online_users(room)),
+        ('is_user_blocked',
+         UserBlock.objects.filter(user_id=1, is_active=True)),
+        ('unblock_expired_users',
+         UserBlock.expired_blocks(now).order_by('blocked_until')[:500]),
+        ('blocked_users_dashboard: active blocks',
+         UserBlock.objects.filter(is_active=True).order_by('-blocked_at')),
+        ('index: page of the public room directory',
+         ChatRoom.objects.filter(room_type='public').order_by('-created_at', '-id')[:20]),
+        ('index: online counts for a directory page',
+         UserPresence.objects.filter(room_id__in=[1, 2, 3], is_online=True, last_seen__gte=now)
+         .values('room_id').annotate(online=Count('id'))),
+        ('private_rooms: owned rooms',
+         ChatRoom.objects.filter(owner_id=1, room_type='private').order_by('-created_at')),
+        ('join_private_room: access code lookup',
+         ChatRoom.objects.filter(access_code='ABCD1234', room_type='private')),
+        ('private room membership check',
+         PrivateRoomMembership.objects.filter(user_id=1, room=room)),
+        ('search_room: messages matching a query',
+         search.filter(ChatMessage.objects.filter(room=room), ['hello']).order_by('-created_at', '-id')[:31]),
+        ('MessageReaction.summarize',
+         MessageReactionCount.objects.filter(message_id__in=[1, 2, 3])),
+    ]
+
+
+def full_scans(plan, vendor):
+    """Lines of a plan that read an entire table"""
+    lines = [line.strip() for line in plan.splitlines()]
+    if vendor == 'postgresql':
+        return [line for line in lines if 'Seq Scan' in line]
+    # SQLite: "SEARCH ...", "SCAN ... USING INDEX" and FTS5 lookups are fine, a bare "SCAN table" is not
+    return [
+        line for line in lines
+        if ' SCAN ' in f' {line} ' and 'USING' not in line and 'CONSTANT ROW' not in line
+        and 'VIRTUAL TABLE INDEX' not in line
+    ]
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot chat queries and fail if any of them does a sequential scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true',
+                            help='Print the full plan of every query')
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(f'Query plan checks are not supported on {vendor}.')
+
+        failures = []
+        with transaction.atomic():
+            if vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for label, queryset in hot_queries():
+                plan = queryset.explain()
+                scans = full_scans(plan, vendor)
+                if scans:
+                    failures.append(label)
+                    self.stdout.write(self.style.ERROR(f'SEQ SCAN  {label}'))
+                    for line in scans:
+                        self.stdout.write(f'    {line}')
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'ok        {label}'))
+                if options['verbose_plans']:
+                    self.stdout.write('\n'.join(f'    {line}' for line in plan.splitlines()))
+
+        if failures:
+            raise CommandError(f'{len(failures)} hot query(s) fall back to a sequential scan.')
+        self.stdout.write(self.style.SUCCESS('All hot queries use an index.'))
@@ -0,0 +1,44 @@
+"""
+Management command that removes abandoned chunked uploads.
+
+An upload the client never finished leaves a row and a partial file under
+``chat_files/<slug>/.uploads/``. Run this periodically (e.g. from cron) to
+delete incomplete uploads that have not received a chunk for ``--hours``,
+and stored attachments that no message ended up using.
+"""
+
+import os
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chatapp.models import Attachment, ChunkedUpload
+
+
+class Command(BaseCommand):
+    help = 'Delete stalled chunked uploads and unused attachments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24,
+                            help='Delete uploads idle for this many hours (default: 24)')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        stale = ChunkedUpload.objects.filter(message__isnull=True, updated_at__lt=cutoff).select_related('room')
+
+        removed = 0
+        for upload in stale.iterator():
+            try:
+                os.remove(upload.part_path)
+            except FileNotFoundError:
+                pass
+            upload.delete()
+            removed += 1
+
+        # Stored, but the message that was to use it was never created
+        orphans = 0
+        for attachment_id in Attachment.objects.filter(ref_count=0, created_at__lt=cutoff).values_list('id', flat=True):
+            orphans += Attachment.release(attachment_id)
+
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} stale upload(s) and {orphans} unused attachment(s).'))
@@ -0,0 +1,75 @@
+"""
+Management command that lifts temporary user blocks as they expire.
+
+Run it alongside the web workers. It keeps a min-heap of upcoming
+``blocked_until`` times, sleeps until the next one is due and deactivates
+every expired block in indexed batches, so ``is_active`` stays accurate
+without each read re-checking expiry. New blocks are picked up when the
+heap is reloaded every ``--refresh`` seconds.
+"""
+
+import heapq
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from chatapp.models import UserBlock
+
+
+class Command(BaseCommand):
+    help = 'Deactivate temporary user blocks when they expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process blocks that have already expired and exit')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Blocks deactivated per UPDATE (default: 500)')
+        parser.add_argument('--refresh', type=float, default=60,
+                            help='Seconds between reloads of upcoming expiries (default: 60)')
+        parser.add_argument('--lookahead', type=int, default=1000,
+                            help='Upcoming expiries kept in memory (default: 1000)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        if options['once']:
+            processed = UserBlock.unblock_expired_users(batch_size=batch_size)
+            self.stdout.write(self.style.SUCCESS(f'Unblocked {processed} expired block(s).'))
+            return
+
+        self.stdout.write(f'Watching temporary blocks (refresh every {options["refresh"]}s)...')
+        total = 0
+        try:
+            while True:
+                total += self.run_until_refresh(batch_size, options['refresh'], options['lookahead'])
+                close_old_connections()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS(f'Stopped after unblocking {total} block(s).'))
+
+    def run_until_refresh(self, batch_size, refresh, lookahead):
+        """Expire blocks from a freshly loaded heap until the next reload is due"""
+        heap = UserBlock.upcoming_expiries(limit=lookahead)
+        heapq.heapify(heap)
+        reload_at = time.monotonic() + refresh
+        processed = 0
+
+        while True:
+            # Expired blocks are always due; anything beyond the heap waits for the reload
+            now = timezone.now()
+            if heap and heap[0][0] <= now:
+                while heap and heap[0][0] <= now:
+                    heapq.heappop(heap)
+                count = UserBlock.unblock_expired_users(batch_size=batch_size)
+                if count:
+                    processed += count
+                    self.stdout.write(f'{now:%Y-%m-%d %H:%M:%S} unblocked {count} expired block(s)')
+                continue
+
+            remaining = reload_at - time.monotonic()
+            if remaining <= 0:
+                return processed
+            if heap:
+                remaining = min(remaining, (heap[0][0] - now).total_seconds())
+            time.sleep(max(remaining, 0))
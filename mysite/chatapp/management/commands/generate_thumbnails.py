@@ -0,0 +1,32 @@
+"""
+Management command that creates thumbnails for existing image messages.
+
+New images get their thumbnails in the background as they are posted; run
+this once after deploying to cover images posted before, or with ``--all``
+after changing ``CHAT_THUMBNAIL_SIZES``.
+"""
+
+from django.core.management.base import BaseCommand
+
+from chatapp.models import ChatMessage
+from chatapp.thumbnails import thumbnail_pool
+
+
+class Command(BaseCommand):
+    help = 'Create WebP thumbnails for image messages that do not have them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate thumbnails for every image message')
+
+    def handle(self, *args, **options):
+        images = ChatMessage.objects.filter(message_type='image').exclude(file='').exclude(file__isnull=True)
+        if not options['all']:
+            images = images.filter(thumbnails={})
+
+        reuse = not options['all']
+        futures = [thumbnail_pool.submit(message_id, reuse) for message_id in images.values_list('id', flat=True).iterator()]
+        done = sum(1 for future in futures if future.result())
+        thumbnail_pool.close()
+
+        self.stdout.write(self.style.SUCCESS(f'Created thumbnails for {done} of {len(futures)} image(s).'))
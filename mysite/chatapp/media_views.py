@@ -0,0 +1,191 @@
+"""
+Serving of uploaded chat files.
+
+Every request under ``MEDIA_URL`` is checked against the room the file was
+posted in, so files from private rooms only reach the owner and members.
+Responses carry a strong ETag and Last-Modified, answer conditional requests
+with 304 and a single byte range with 206, so media players can seek and
+interrupted downloads can resume.
+
+With ``MEDIA_ACCEL`` set, the transfer itself is handed to the front proxy
+once access is checked: ``nginx`` gets an ``X-Accel-Redirect`` under
+``MEDIA_ACCEL_PREFIX``, ``sendfile`` (Apache mod_xsendfile, lighttpd) gets an
+``X-Sendfile`` path. Otherwise the file is streamed with ``FileResponse``,
+which WSGI servers such as gunicorn send with ``os.sendfile``.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from .access import accessible_rooms_filter
+from .models import ChatMessage, ChatRoom
+from .storage import BLOB_PREFIX
+
+MEDIA_ACCEL = getattr(settings, 'MEDIA_ACCEL', '')
+MEDIA_ACCEL_PREFIX = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+BLOCK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile:
+    """Reads at most length bytes of a file from its current position
+
+    fileno() is kept, so wsgi.file_wrapper can still sendfile() the range;
+    such servers stop at the response's Content-Length.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def blob_digest(path):
+    """SHA-256 a blob or blob thumbnail path belongs to"""
+    directory, base = posixpath.split(path)
+    stem = os.path.splitext(base)[0]
+    if posixpath.basename(directory) == 'thumbs':
+        stem = stem.rsplit('_', 1)[0]
+    return stem
+
+
+def user_can_access(user, path):
+    """Whether the room a media file was posted in is open to user"""
+    parts = path.split('/')
+    if parts[0] != 'chat_files':
+        return True
+    if len(parts) < 3 or '.uploads' in parts or '.tmp' in parts:
+        return False
+
+    if path.startswith(BLOB_PREFIX + '/'):
+        # Shared blobs are served if any message using them is in a room the user can see
+        return ChatMessage.objects.filter(
+            accessible_rooms_filter(user, prefix='room__'),
+            attachment__sha256=blob_digest(path)
+        ).exists()
+    return ChatRoom.objects.filter(accessible_rooms_filter(user), slug=parts[1]).exists()
+
+
+def parse_range(header, size):
+    """(first, last) byte of a single Range, False if unsatisfiable, None to ignore it"""
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        # Multiple or malformed ranges: sending the whole file is always allowed
+        return None
+    first, last = match.groups()
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            return False
+        return max(size - suffix, 0), size - 1
+    first = int(first)
+    if first >= size:
+        return False
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        return None
+    return first, last
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+@require_safe
+def serve_media(request, path):
+    """Serve an uploaded file with access checks, conditional GET and Range support"""
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+
+    # Not found and not allowed look the same, so private files cannot be probed
+    if not user_can_access(request.user, path):
+        raise Http404('File not found')
+    try:
+        file_stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('File not found')
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404('File not found')
+
+    size = file_stat.st_size
+    last_modified = int(file_stat.st_mtime)
+    if path.startswith(BLOB_PREFIX + '/') and '/thumbs/' not in path:
+        # Content-addressed: the name is the hash of the bytes
+        etag = f'"{blob_digest(path)}"'
+        cache_control = 'private, max-age=31536000, immutable'
+    else:
+        etag = f'"{size:x}-{file_stat.st_mtime_ns:x}"'
+        cache_control = 'private, no-cache'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['Cache-Control'] = cache_control
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    if MEDIA_ACCEL == 'nginx':
+        # nginx serves the bytes, ranges included, from an internal location
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = MEDIA_ACCEL_PREFIX.rstrip('/') + '/' + quote(path)
+    elif MEDIA_ACCEL == 'sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+    else:
+        first, last = 0, size - 1
+        byte_range = None
+        if 'Range' in request.headers and if_range_matches(request, etag, last_modified):
+            byte_range = parse_range(request.headers['Range'], size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range:
+            first, last = byte_range
+
+        file = open(full_path, 'rb')
+        file.seek(first)
+        response = FileResponse(RangeFile(file, last - first + 1), content_type=content_type)
+        response.block_size = BLOCK_SIZE
+        response['Content-Length'] = last - first + 1
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {first}-{last}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = cache_control
+    return response
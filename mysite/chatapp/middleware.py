@@ -0,0 +1,100 @@
+"""
+Middleware for the chat app's polling endpoints.
+
+``PollNotModifiedMiddleware`` answers conditional ``get_messages`` polls
+with 304 straight from the room's cached high-water mark. It sits before
+``SessionMiddleware``, so an idle poll loads no session, no user and no room
+and costs no database queries at all. Like the mark itself, it is only
+active with ``CHAT_HIGH_WATER_CACHE``, i.e. a cache every worker shares.
+
+``SessionRefreshMiddleware`` stands in for ``SESSION_SAVE_EVERY_REQUEST``:
+polls and presence pings that do not change the session no longer save it,
+except once every ``SESSION_REFRESH_INTERVAL`` seconds to keep it from expiring.
+"""
+import time
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.urls import Resolver404, resolve
+from django.utils.crypto import salted_hmac
+from django.utils.http import parse_etags
+
+from .models import ChatMessage
+
+
+def poll_etag(request, slug, high_water):
+    """ETag of a get_messages response while a room's newest message is high_water
+
+    Signed and tied to the session cookie, so it cannot be guessed or reused
+    by anyone the view did not check room access for and give it to.
+    """
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')
+    digest = salted_hmac('chatapp.poll_etag', f'{slug}:{high_water}:{session_key}').hexdigest()[:20]
+    return f'"{digest}"'
+
+
+class PollNotModifiedMiddleware:
+    """Return 304 for get_messages polls when the room has no new messages"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method == 'GET' and 'HTTP_IF_NONE_MATCH' in request.META:
+            response = self.not_modified(request)
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    def not_modified(self, request):
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.url_name != 'get_messages':
+            return None
+
+        slug = match.kwargs['slug']
+        high_water = ChatMessage.high_water_mark(slug)
+        if high_water is None:
+            return None
+        etag = poll_etag(request, slug, high_water)
+        if etag not in parse_etags(request.META['HTTP_IF_NONE_MATCH']):
+            return None
+
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+
+class SessionRefreshMiddleware:
+    """Save unchanged sessions only once they are due for a new expiry date
+
+    Each session records when it was last saved. A request that leaves it
+    unchanged marks it modified, so SessionMiddleware saves it and re-sends
+    the cookie, only when that was SESSION_REFRESH_INTERVAL or more ago.
+    Sessions therefore still slide forward while in use, but expire up to
+    one interval earlier than when every request saved them.
+    """
+
+    REFRESHED_KEY = '_session_refreshed_at'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.interval = getattr(settings, 'SESSION_REFRESH_INTERVAL', 3600)
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        session = getattr(request, 'session', None)
+        # Sessions the request never loaded stay unloaded; SESSION_SAVE_EVERY_REQUEST saves them anyway
+        if session is not None and session.accessed and not settings.SESSION_SAVE_EVERY_REQUEST:
+            self.refresh(session)
+        return response
+
+    def refresh(self, session):
+        # Empty sessions (anonymous visitors, logout) are not worth creating or keeping
+        if session.is_empty():
+            return
+        now = int(time.time())
+        if session.modified or now - session.get(self.REFRESHED_KEY, 0) >= self.interval:
+            session[self.REFRESHED_KEY] = now
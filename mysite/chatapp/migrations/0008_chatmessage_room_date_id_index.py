@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:09
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0007_userblock'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'date', 'id'], name='chatmsg_room_date_id_idx'),
+        ),
+    ]
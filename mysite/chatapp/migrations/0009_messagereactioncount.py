@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_reaction_counts(apps, schema_editor):
+    """Build counters for reactions that already exist"""
+    MessageReaction = apps.get_model('chatapp', 'MessageReaction')
+    MessageReactionCount = apps.get_model('chatapp', 'MessageReactionCount')
+    
+    totals = MessageReaction.objects.values('message_id', 'emoji').annotate(total=Count('id')).order_by()
+    MessageReactionCount.objects.bulk_create(
+        (MessageReactionCount(message_id=row['message_id'], emoji=row['emoji'], count=row['total']) for row in totals),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0008_chatmessage_room_date_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageReactionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(choices=[('👍', 'Thumbs Up'), ('👎', 'Thumbs Down'), ('❤️', 'Heart'), ('😂', 'Laughing'), ('😮', 'Wow'), ('😢', 'Sad'), ('😡', 'Angry'), ('🎉', 'Party'), ('🔥', 'Fire'), ('💯', 'Hundred')], max_length=10)),
+                ('count', models.IntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_counts', to='chatapp.chatmessage')),
+            ],
+            options={
+                'unique_together': {('message', 'emoji')},
+            },
+        ),
+        migrations.RunPython(backfill_reaction_counts, migrations.RunPython.noop),
+    ]
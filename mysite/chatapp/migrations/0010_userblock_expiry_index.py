@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0009_messagereactioncount'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userblock',
+            index=models.Index(condition=models.Q(('block_type', 'temporary'), ('is_active', True)), fields=['blocked_until'], name='userblock_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0010_userblock_expiry_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'id'], name='chatmsg_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['room_type', '-created_at'], name='chatroom_type_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userblock',
+            index=models.Index(fields=['user', 'is_active'], name='userblock_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userblock',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-blocked_at'], name='userblock_active_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userpresence',
+            index=models.Index(fields=['room', 'is_online', 'last_seen'], name='presence_room_online_seen_idx'),
+        ),
+    ]
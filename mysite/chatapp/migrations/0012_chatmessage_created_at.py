@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0011_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={'ordering': ('created_at', 'id')},
+        ),
+        # Added as a plain nullable column: with auto_now_add the schema editor
+        # would fill every existing row with the current time. Existing rows
+        # are backfilled from date in 0013.
+        migrations.AddField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        # auto_now_add only matters to Django, so leave the table alone
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatmessage',
+                    name='created_at',
+                    field=models.DateTimeField(auto_now_add=True, null=True),
+                ),
+            ],
+        ),
+    ]
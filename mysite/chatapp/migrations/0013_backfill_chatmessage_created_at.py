@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.models import F
+
+BATCH_SIZE = 1000
+
+
+def backfill_created_at(apps, schema_editor):
+    """Copy date into created_at in small committed batches
+
+    Each batch is its own short transaction, so rows are never locked for
+    long, and rows that already have created_at are skipped, so the migration
+    can be stopped and re-run to resume where it left off.
+    """
+    ChatMessage = apps.get_model('chatapp', 'ChatMessage')
+    last_id = 0
+    while True:
+        ids = list(
+            ChatMessage.objects.filter(id__gt=last_id, created_at__isnull=True)
+            .order_by('id')
+            .values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not ids:
+            break
+        ChatMessage.objects.filter(id__in=ids, created_at__isnull=True).update(created_at=F('date'))
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chatapp', '0012_chatmessage_created_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop, elidable=True),
+    ]
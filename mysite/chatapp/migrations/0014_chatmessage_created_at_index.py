@@ -0,0 +1,56 @@
+from django.db import migrations, models
+
+
+def _index_options(schema_editor):
+    # CREATE/DROP INDEX CONCURRENTLY keeps the table writable on PostgreSQL
+    return {'concurrently': True} if schema_editor.connection.vendor == 'postgresql' else {}
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """AddIndex that does not lock the table on PostgreSQL"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, **_index_options(schema_editor))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, **_index_options(schema_editor))
+
+
+class RemoveIndexConcurrently(migrations.RemoveIndex):
+    """RemoveIndex that does not lock the table on PostgreSQL"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            index = from_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            schema_editor.remove_index(model, index, **_index_options(schema_editor))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            index = to_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            schema_editor.add_index(model, index, **_index_options(schema_editor))
+
+
+class Migration(migrations.Migration):
+    # Concurrent index builds cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('chatapp', '0013_backfill_chatmessage_created_at'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'created_at', 'id'], name='chatmsg_room_created_id_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='chatmessage',
+            name='chatmsg_room_date_id_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0015_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:34
+
+import chatapp.models
+import chatapp.storage
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0016_chatmessage_thumbnails'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(max_length=255, storage=chatapp.storage.ContentAddressedStorage(), upload_to='')),
+                ('size', models.BigIntegerField()),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='file',
+            field=models.FileField(blank=True, null=True, storage=chatapp.storage.ContentAddressedStorage(), upload_to=chatapp.models.upload_to_chat_files),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='attachment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='chatapp.attachment'),
+        ),
+    ]
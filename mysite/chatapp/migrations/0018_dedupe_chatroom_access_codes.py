@@ -0,0 +1,47 @@
+import secrets
+import string
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def new_code(taken):
+    while True:
+        code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+        if code not in taken:
+            taken.add(code)
+            return code
+
+
+def dedupe_access_codes(apps, schema_editor):
+    """Give every private room but the oldest a new code where codes collide
+
+    Public rooms lose their code, and private rooms without one get one, so
+    the unique constraint added next only sees real codes.
+    """
+    ChatRoom = apps.get_model('chatapp', 'ChatRoom')
+    ChatRoom.objects.filter(room_type='public').exclude(access_code=None).update(access_code=None)
+    ChatRoom.objects.filter(access_code='').update(access_code=None)
+
+    duplicates = (
+        ChatRoom.objects.exclude(access_code=None)
+        .values('access_code').annotate(rooms=Count('id')).filter(rooms__gt=1)
+        .values_list('access_code', flat=True)
+    )
+    taken = set(ChatRoom.objects.exclude(access_code=None).values_list('access_code', flat=True))
+    for code in list(duplicates):
+        for room_id in ChatRoom.objects.filter(access_code=code).order_by('id').values_list('id', flat=True)[1:]:
+            ChatRoom.objects.filter(pk=room_id).update(access_code=new_code(taken))
+    for room_id in ChatRoom.objects.filter(room_type='private', access_code=None).values_list('id', flat=True):
+        ChatRoom.objects.filter(pk=room_id).update(access_code=new_code(taken))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0017_attachment'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_access_codes, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0018_dedupe_chatroom_access_codes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroom',
+            name='access_code',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0019_chatroom_access_code_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def backfill_room_activity(apps, schema_editor):
+    """Count each room's messages once; afterwards the counters are kept up to date
+
+    One short transaction per room, so the migration can be stopped and re-run.
+    """
+    ChatRoom = apps.get_model('chatapp', 'ChatRoom')
+    ChatMessage = apps.get_model('chatapp', 'ChatMessage')
+    for room_id in ChatRoom.objects.order_by('id').values_list('id', flat=True):
+        stats = ChatMessage.objects.filter(room_id=room_id).aggregate(count=Count('id'), last=Max('created_at'))
+        ChatRoom.objects.filter(pk=room_id).update(message_count=stats['count'], last_activity_at=stats['last'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chatapp', '0020_chatroom_activity_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_room_activity, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.1.1 on 2026-10-18 16:05
+
+from django.db import migrations
+
+FTS_TABLE = 'chatapp_chatmessage_fts'
+
+
+class CreateMessageSearchIndex(migrations.operations.base.Operation):
+    """Full-text index on message content, built the way each database supports
+
+    PostgreSQL gets a GIN index on to_tsvector('simple', message_content),
+    built without locking the table. SQLite gets an FTS5 table over the
+    messages, filled once and kept in sync by triggers. Other databases get
+    nothing and search falls back to substring matching.
+    """
+
+    reversible = True
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            schema_editor.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS chatmsg_content_fts_idx "
+                "ON chatapp_chatmessage USING gin (to_tsvector('simple', message_content))"
+            )
+        elif vendor == 'sqlite':
+            schema_editor.execute(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                f"message_content, content='chatapp_chatmessage', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+            schema_editor.execute(f"""
+                CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON chatapp_chatmessage BEGIN
+                    INSERT INTO {FTS_TABLE}(rowid, message_content) VALUES (new.id, new.message_content);
+                END
+            """)
+            schema_editor.execute(f"""
+                CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON chatapp_chatmessage BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_content)
+                    VALUES ('delete', old.id, old.message_content);
+                END
+            """)
+            schema_editor.execute(f"""
+                CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF message_content ON chatapp_chatmessage BEGIN
+                    INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_content)
+                    VALUES ('delete', old.id, old.message_content);
+                    INSERT INTO {FTS_TABLE}(rowid, message_content) VALUES (new.id, new.message_content);
+                END
+            """)
+            # Index the messages that already exist
+            schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS chatmsg_content_fts_idx')
+        elif vendor == 'sqlite':
+            for suffix in ('ai', 'ad', 'au'):
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+    def describe(self):
+        return 'Create the full-text search index on chat message content'
+
+
+class Migration(migrations.Migration):
+    # Concurrent index builds cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('chatapp', '0021_backfill_chatroom_activity'),
+    ]
+
+    operations = [
+        CreateMessageSearchIndex(),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models import F
+
+BATCH_SIZE = 1000
+
+
+def backfill_created_at(apps, schema_editor):
+    """Fill created_at on rows inserted without it since 0013 ran
+
+    Code deployed before 0012 kept inserting messages while the backfill
+    rolled out; their created_at is copied from date in small batches, the
+    same way 0013 did it.
+    """
+    ChatMessage = apps.get_model('chatapp', 'ChatMessage')
+    while True:
+        ids = list(
+            ChatMessage.objects.filter(created_at__isnull=True)
+            .order_by('id')
+            .values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not ids:
+            break
+        ChatMessage.objects.filter(id__in=ids, created_at__isnull=True).update(created_at=F('date'))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chatapp', '0022_chatmessage_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop, elidable=True),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+    ]
@@ -1,12 +1,34 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.utils import timezone
+
+from .storage import attachment_storage
+import mimetypes
 import os
 import secrets
 import string
+import uuid
 
 # Create your models here.
 
+# How long a "not blocked" / permanent block lookup may be served from cache
+BLOCK_CACHE_TIMEOUT = getattr(settings, 'CHAT_BLOCK_CACHE_TIMEOUT', 300)  # seconds
+_NOT_CACHED = object()
+# Latest message id per room; a safety net in case a bump is lost
+HIGH_WATER_TIMEOUT = getattr(settings, 'CHAT_HIGH_WATER_TIMEOUT', 300)  # seconds
+# Bumps only reach other workers through a shared cache; with a per-process one
+# they would keep answering "nothing new" until their copy expired
+HIGH_WATER_CACHE = getattr(
+    settings, 'CHAT_HIGH_WATER_CACHE',
+    not settings.CACHES['default']['BACKEND'].endswith(('LocMemCache', 'DummyCache'))
+)
+# Fresh codes drawn before giving up on a private room's access code
+ACCESS_CODE_ATTEMPTS = 5
+
 class UserBlock(models.Model):
     """Model to manage user blocking by admins"""
     BLOCK_TYPES = (
@@ -24,6 +46,27 @@ class UserBlock(models.Model):
     
     class Meta:
         ordering = ('-blocked_at',)
+        indexes = [
+            # is_user_blocked and the admin "deactivate existing blocks" updates
+            models.Index(fields=['user', 'is_active'], name='userblock_user_active_idx'),
+            # Blocked users dashboard: active blocks, newest first
+            models.Index(fields=['-blocked_at'], name='userblock_active_recent_idx', condition=Q(is_active=True)),
+            models.Index(
+                fields=['blocked_until'],
+                name='userblock_expiry_idx',
+                condition=Q(block_type='temporary', is_active=True),
+            ),
+        ]
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.invalidate_block_cache(self.user_id)
+    
+    def delete(self, *args, **kwargs):
+        user_id = self.user_id
+        result = super().delete(*args, **kwargs)
+        self.invalidate_block_cache(user_id)
+        return result
     
     def __str__(self):
         if self.block_type == 'permanent':
@@ -39,29 +82,85 @@ class UserBlock(models.Model):
             return True
         return self.blocked_until and timezone.now() < self.blocked_until
     
+    @staticmethod
+    def block_cache_key(user_id):
+        return 'chatapp:user-block:%s' % user_id
+    
+    @classmethod
+    def invalidate_block_cache(cls, user_id):
+        """Forget a user's cached block status, now and again once committed"""
+        key = cls.block_cache_key(user_id)
+        cache.delete(key)
+        # A concurrent lookup may re-cache the old state before we commit
+        transaction.on_commit(lambda: cache.delete(key))
+    
+    @classmethod
+    def deactivate_user_blocks(cls, user):
+        """Lift every active block on a user; returns how many were lifted"""
+        updated_count = cls.objects.filter(user=user, is_active=True).update(is_active=False)
+        cls.invalidate_block_cache(user.pk)
+        return updated_count
+    
     @classmethod
     def is_user_blocked(cls, user):
         """Check if a user is currently blocked"""
-        active_blocks = cls.objects.filter(
-            user=user,
-            is_active=True
-        )
+        key = cls.block_cache_key(user.pk)
+        block = cache.get(key, _NOT_CACHED)
+        if block is not _NOT_CACHED:
+            # Cached blocks expire when they lapse; re-check for clock skew
+            return block if block is not None and block.is_currently_blocked else None
         
-        for block in active_blocks:
-            if block.is_currently_blocked:
-                return block
-        return None
+        current = [
+            block for block in cls.objects.filter(user=user, is_active=True)
+            if block.is_currently_blocked
+        ]
+        block = current[0] if current else None
+        
+        # Re-evaluate as soon as the first temporary block lapses
+        timeout = BLOCK_CACHE_TIMEOUT
+        lapses = [b.blocked_until for b in current if b.block_type != 'permanent']
+        if lapses:
+            timeout = min(timeout, (min(lapses) - timezone.now()).total_seconds())
+        if timeout > 0:
+            cache.set(key, block, timeout)
+        return block
     
     @classmethod
-    def unblock_expired_users(cls):
-        """Automatically unblock users whose temporary blocks have expired"""
-        expired_blocks = cls.objects.filter(
+    def expired_blocks(cls, now=None):
+        """Active temporary blocks whose time is up (served by userblock_expiry_idx)"""
+        return cls.objects.filter(
             block_type='temporary',
             is_active=True,
-            blocked_until__lte=timezone.now()
+            blocked_until__lte=now or timezone.now()
         )
-        expired_blocks.update(is_active=False)
-        return expired_blocks.count()
+    
+    @classmethod
+    def upcoming_expiries(cls, limit=1000):
+        """(blocked_until, id) of the next active temporary blocks to lapse"""
+        return list(cls.objects.filter(
+            block_type='temporary',
+            is_active=True,
+            blocked_until__isnull=False
+        ).order_by('blocked_until').values_list('blocked_until', 'id')[:limit])
+    
+    @classmethod
+    def unblock_expired_users(cls, batch_size=500):
+        """Automatically unblock users whose temporary blocks have expired"""
+        now = timezone.now()
+        processed = 0
+        while True:
+            batch = list(cls.expired_blocks(now).order_by('blocked_until').values_list('id', 'user_id')[:batch_size])
+            if not batch:
+                break
+            processed += cls.objects.filter(
+                id__in=[block_id for block_id, _ in batch],
+                is_active=True
+            ).update(is_active=False)
+            for user_id in {user_id for _, user_id in batch}:
+                cls.invalidate_block_cache(user_id)
+            if len(batch) < batch_size:
+                break
+        return processed
 
 class ChatRoom(models.Model):
     ROOM_TYPES = (
@@ -72,9 +171,19 @@ class ChatRoom(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True)
     room_type = models.CharField(max_length=10, choices=ROOM_TYPES, default='public')
-    access_code = models.CharField(max_length=20, blank=True, null=True)
+    # Unique, so joining by code is one index lookup however many private rooms exist
+    access_code = models.CharField(max_length=20, blank=True, null=True, unique=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Kept up to date as messages are posted and deleted, so listings never count messages
+    message_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # Room listings: public rooms on the index page, newest first
+            models.Index(fields=['room_type', '-created_at'], name='chatroom_type_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} ({'Private' if self.room_type == 'private' else 'Public'})"
@@ -82,11 +191,39 @@ class ChatRoom(models.Model):
     def save(self, *args, **kwargs):
         # Generate access code for private rooms
         if self.room_type == 'private' and not self.access_code:
-            self.access_code = self.generate_access_code()
+            self.save_with_new_access_code(*args, **kwargs)
+            return
         elif self.room_type == 'public':
             self.access_code = None
         super().save(*args, **kwargs)
     
+    def save_with_new_access_code(self, *args, **kwargs):
+        """Save with a fresh access code, drawing another if it is already taken"""
+        for attempt in range(ACCESS_CODE_ATTEMPTS):
+            self.access_code = self.generate_access_code()
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                return
+            except IntegrityError:
+                # Anything other than a code collision (e.g. a duplicate slug) is the caller's problem
+                if not ChatRoom.objects.filter(access_code=self.access_code).exists():
+                    raise
+        raise IntegrityError(f'No free access code after {ACCESS_CODE_ATTEMPTS} attempts')
+    
+    @classmethod
+    def record_messages(cls, room_id, count, last_at=None):
+        """Adjust a room's message counter; last_at is the newest new message's time"""
+        if count > 0:
+            cls.objects.filter(pk=room_id).update(message_count=F('message_count') + count, last_activity_at=last_at)
+        elif count < 0:
+            cls.objects.filter(pk=room_id, message_count__gte=-count).update(message_count=F('message_count') + count)
+    
+    def user_has_access(self, user):
+        """Public rooms are open to everyone; private ones to the owner and members"""
+        from .access import can_access_room
+        return can_access_room(user, self)
+    
     def generate_access_code(self):
         """Generate a unique 8-character access code for private rooms"""
         return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(8))
@@ -113,32 +250,68 @@ class UserPresence(models.Model):
     
     class Meta:
         unique_together = ('user', 'room')
+        indexes = [
+            # get_online_users: online users of a room seen recently
+            models.Index(fields=['room', 'is_online', 'last_seen'], name='presence_room_online_seen_idx'),
+        ]
     
     def __str__(self):
         return f'{self.user.username} in {self.room.name} - {"Online" if self.is_online else "Offline"}'
     
+    @classmethod
+    def upsert_online(cls, pairs):
+        """Mark (user_id, room_id) pairs online with a single INSERT ... ON CONFLICT"""
+        return cls.objects.bulk_create(
+            [cls(user_id=user_id, room_id=room_id, is_online=True) for user_id, room_id in pairs],
+            update_conflicts=True,
+            unique_fields=['user', 'room'],
+            update_fields=['is_online', 'last_seen'],
+        )
+    
     @classmethod
     def update_user_presence(cls, user, room):
         """Update or create user presence in a room"""
-        presence, created = cls.objects.get_or_create(
-            user=user, 
-            room=room,
-            defaults={'is_online': True}
-        )
-        if not created:
-            presence.is_online = True
-            presence.save()
-        return presence
+        return cls.upsert_online([(user.id, room.id)])[0]
     
     @classmethod
     def set_user_offline(cls, user, room):
         """Set user offline in a room"""
-        try:
-            presence = cls.objects.get(user=user, room=room)
-            presence.is_online = False
-            presence.save()
-        except cls.DoesNotExist:
-            pass
+        cls.objects.filter(user=user, room=room).update(is_online=False, last_seen=timezone.now())
+    
+    @staticmethod
+    def existing_pairs(pairs):
+        """The (user_id, room_id) pairs whose user and room both still exist"""
+        user_ids = set(User.objects.filter(pk__in={user_id for user_id, _ in pairs}).values_list('id', flat=True))
+        room_ids = set(ChatRoom.objects.filter(pk__in={room_id for _, room_id in pairs}).values_list('id', flat=True))
+        return [(user_id, room_id) for user_id, room_id in pairs if user_id in user_ids and room_id in room_ids]
+    
+    @classmethod
+    def bulk_set_presence(cls, online, offline):
+        """Persist a presence snapshot given lists of (user_id, room_id) pairs
+
+        Pairs whose user or room has been deleted since they were queued are
+        skipped, so they cannot fail the whole batch on the foreign keys.
+        """
+        if online:
+            online = cls.existing_pairs(online)
+        if online:
+            cls.upsert_online(online)
+        if offline:
+            pairs = Q()
+            for user_id, room_id in offline:
+                pairs |= Q(user_id=user_id, room_id=room_id)
+            cls.objects.filter(pairs).update(is_online=False, last_seen=timezone.now())
+    
+    @classmethod
+    def online_counts(cls, room_ids):
+        """{room_id: users online} for several rooms in one grouped query"""
+        cutoff_time = timezone.now() - timezone.timedelta(minutes=5)
+        rows = cls.objects.filter(
+            room_id__in=room_ids,
+            is_online=True,
+            last_seen__gte=cutoff_time
+        ).values('room_id').annotate(online=Count('id')).values_list('room_id', 'online')
+        return dict(rows)
     
     @classmethod
     def get_online_users(cls, room):
@@ -154,6 +327,97 @@ class UserPresence(models.Model):
 def upload_to_chat_files(instance, filename):
     return f'chat_files/{instance.room.slug}/{filename}'
 
+def format_file_size(size):
+    if size == 0:
+        return ''
+    if size < 1024:
+        return f'{size} B'
+    elif size < 1024 * 1024:
+        return f'{size // 1024} KB'
+    else:
+        return f'{size // (1024 * 1024)} MB'
+
+class Attachment(models.Model):
+    """A stored file, shared by every message that posted the same bytes"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(storage=attachment_storage, max_length=255)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, blank=True)
+    # Messages that use this file; the blob is deleted when it drops to zero
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f'{self.sha256[:12]} ({format_file_size(self.size)}, {self.ref_count} refs)'
+    
+    @property
+    def is_image(self):
+        return self.content_type.startswith('image/')
+    
+    @classmethod
+    def _record(cls, name, size, file_name, content_type):
+        """The row for a stored blob, locked until the caller's transaction ends
+
+        The lock makes a concurrent purge of the same blob wait until the
+        caller's message has counted its reference.
+        """
+        content_type = content_type or mimetypes.guess_type(file_name)[0] or ''
+        attachment, _ = cls.objects.select_for_update().get_or_create(
+            sha256=attachment_storage.digest_of(name),
+            defaults={'file': name, 'size': size, 'content_type': content_type[:100]}
+        )
+        return attachment
+    
+    @classmethod
+    def store(cls, uploaded_file, content_type=''):
+        """Save an uploaded file, reusing the blob if the same bytes are already stored"""
+        with transaction.atomic():
+            name = attachment_storage.save(uploaded_file.name, uploaded_file)
+            attachment = cls._record(name, uploaded_file.size, uploaded_file.name, content_type)
+            if not attachment_storage.exists(name):
+                # The blob found by save was purged before the row could be locked
+                attachment_storage.save(uploaded_file.name, uploaded_file)
+            return attachment
+    
+    @classmethod
+    def store_path(cls, path, sha256, file_name, content_type=''):
+        """Move a local file whose hash is already known into the store"""
+        size = os.path.getsize(path)
+        extension = os.path.splitext(file_name)[1]
+        with transaction.atomic():
+            # Lock first, so a purge cannot remove the blob that adopt finds
+            attachment = cls._record(attachment_storage.blob_name(sha256, extension), size, file_name, content_type)
+            attachment_storage.adopt(path, sha256, extension)
+            return attachment
+    
+    @classmethod
+    def add_reference(cls, attachment_id):
+        cls.objects.filter(pk=attachment_id).update(ref_count=F('ref_count') + 1)
+    
+    @classmethod
+    def release(cls, attachment_id):
+        """Drop one reference and purge the blob after the commit once nothing uses it"""
+        cls.objects.filter(pk=attachment_id, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        if not cls.objects.filter(pk=attachment_id, ref_count=0).exists():
+            return False
+        transaction.on_commit(lambda: cls.purge(attachment_id))
+        return True
+    
+    @classmethod
+    def purge(cls, attachment_id):
+        """Delete an unused attachment and its files, unless a new message took it meanwhile"""
+        with transaction.atomic():
+            unused = cls.objects.select_for_update().filter(pk=attachment_id, ref_count=0).first()
+            if unused is None:
+                return False
+            name = unused.file.name
+            unused.delete()
+            # Still under the row lock, so _record for the same bytes waits and then writes a new blob
+            attachment_storage.delete(name)
+            from .thumbnails import delete_thumbnails
+            delete_thumbnails(name)
+        return True
+
 class ChatMessage(models.Model):
     MESSAGE_TYPES = (
         ('text', 'Text'),
@@ -165,13 +429,25 @@ class ChatMessage(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     message_content = models.TextField(blank=True)
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
-    file = models.FileField(upload_to=upload_to_chat_files, blank=True, null=True)
+    file = models.FileField(upload_to=upload_to_chat_files, storage=attachment_storage, blank=True, null=True)
+    # Size, type and reference count of the stored file; null for text and older messages
+    attachment = models.ForeignKey(Attachment, on_delete=models.PROTECT, null=True, blank=True, related_name='messages')
     file_name = models.CharField(max_length=255, blank=True)
     file_size = models.IntegerField(default=0)
+    # {size: storage name} of the WebP thumbnails of an image, filled in the background
+    thumbnails = models.JSONField(default=dict, blank=True)
     date = models.DateTimeField(auto_now=True)
+    # Never changes after the insert, unlike date; all ordering and cursors use it
+    created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        ordering = ('date',)
+        ordering = ('created_at', 'id')
+        indexes = [
+            # Backs keyset pagination of a room's history on (created_at, id)
+            models.Index(fields=['room', 'created_at', 'id'], name='chatmsg_room_created_id_idx'),
+            # get_messages polls for ids newer than the client's last one
+            models.Index(fields=['room', 'id'], name='chatmsg_room_id_idx'),
+        ]
     
     def __str__(self):
         if self.message_type == 'text':
@@ -185,18 +461,134 @@ class ChatMessage(models.Model):
         return ''
     
     def is_image(self):
+        if self.attachment_id:
+            return self.attachment.is_image
         image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
         return self.get_file_extension() in image_extensions
     
     def get_file_size_display(self):
-        if self.file_size == 0:
-            return ''
-        if self.file_size < 1024:
-            return f'{self.file_size} B'
-        elif self.file_size < 1024 * 1024:
-            return f'{self.file_size // 1024} KB'
-        else:
-            return f'{self.file_size // (1024 * 1024)} MB'
+        return format_file_size(self.file_size)
+    
+    @classmethod
+    def thumbnail_urls(cls, thumbnails):
+        """{size: url} for a message's thumbnails, smallest first"""
+        return {size: default_storage.url(name) for size, name in sorted((thumbnails or {}).items(), key=lambda item: int(item[0]))}
+    
+    def get_thumbnail_urls(self):
+        return self.thumbnail_urls(self.thumbnails)
+    
+    def get_thumbnail_url(self):
+        """Smallest thumbnail, or the original until thumbnails exist"""
+        urls = self.get_thumbnail_urls()
+        return next(iter(urls.values())) if urls else self.file.url
+    
+    def get_thumbnail_srcset(self):
+        return ', '.join(f'{url} {size}w' for size, url in self.get_thumbnail_urls().items())
+    
+    def get_preview_url(self):
+        """Largest thumbnail, for the full-screen viewer"""
+        urls = self.get_thumbnail_urls()
+        return list(urls.values())[-1] if urls else self.file.url
+    
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            self.bump_high_water_mark(self.room.slug, self.id)
+            ChatRoom.record_messages(self.room_id, 1, self.created_at)
+            if self.message_type == 'image' and self.file:
+                from .thumbnails import thumbnail_pool
+                thumbnail_pool.schedule(self.id)
+    
+    @staticmethod
+    def high_water_cache_key(slug):
+        return 'chatapp:room-high-water:%s' % slug
+    
+    @classmethod
+    def high_water_mark(cls, slug):
+        """Cached id of the newest message in a room, or None if unknown or not cached"""
+        if not HIGH_WATER_CACHE:
+            return None
+        return cache.get(cls.high_water_cache_key(slug))
+    
+    @classmethod
+    async def ahigh_water_mark(cls, slug):
+        """high_water_mark for the event loop, without blocking it on the cache"""
+        if not HIGH_WATER_CACHE:
+            return None
+        return await cache.aget(cls.high_water_cache_key(slug))
+    
+    @classmethod
+    def refresh_high_water_mark(cls, room):
+        """Load a room's newest message id into the cache and return it"""
+        latest = cls.objects.filter(room=room).order_by('-id').values_list('id', flat=True).first() or 0
+        if HIGH_WATER_CACHE:
+            cache.add(cls.high_water_cache_key(room.slug), latest, HIGH_WATER_TIMEOUT)
+        return latest
+    
+    @classmethod
+    def bump_high_water_mark(cls, slug, message_id):
+        """Record a new message once it is committed and visible to polls"""
+        if not HIGH_WATER_CACHE:
+            return
+        key = cls.high_water_cache_key(slug)
+        
+        def bump():
+            if message_id > (cache.get(key) or 0):
+                cache.set(key, message_id, HIGH_WATER_TIMEOUT)
+        transaction.on_commit(bump)
+    
+    # Columns needed to serialize a message without loading model instances
+    VALUES_FIELDS = (
+        'id', 'user__username', 'message_content', 'message_type',
+        'file', 'file_name', 'file_size', 'thumbnails', 'created_at',
+    )
+    
+    @classmethod
+    def dict_from_values(cls, row, reactions=None):
+        """Same as to_dict() for a row of .values(*VALUES_FIELDS)"""
+        data = {
+            'id': row['id'],
+            'username': row['user__username'],
+            'message': row['message_content'],
+            'message_content': row['message_content'],
+            'message_type': row['message_type'],
+            'time': row['created_at'].strftime('%H:%M'),
+            'date': row['created_at'].isoformat(),
+            'reactions': reactions or {}
+        }
+        
+        if row['file']:
+            data.update({
+                'file_url': cls._meta.get_field('file').storage.url(row['file']),
+                'file_name': row['file_name'],
+                'file_size': format_file_size(row['file_size']),
+                'thumbnails': cls.thumbnail_urls(row['thumbnails'])
+            })
+        return data
+    
+    def to_dict(self, reactions=None):
+        """Serialize the message for the JSON and WebSocket APIs"""
+        data = {
+            'id': self.id,
+            'username': self.user.username,
+            'message': self.message_content,
+            'message_content': self.message_content,
+            'message_type': self.message_type,
+            'time': self.created_at.strftime('%H:%M'),
+            'date': self.created_at.isoformat(),
+            'reactions': reactions or {}
+        }
+        
+        # Add file information if it's a file/image message
+        if self.file:
+            data.update({
+                'file_url': self.file.url,
+                'file_name': self.file_name,
+                'file_size': self.get_file_size_display(),
+                'thumbnails': self.get_thumbnail_urls()
+            })
+        return data
 
 class MessageReaction(models.Model):
     """Model to store emoji reactions to messages"""
@@ -212,6 +604,7 @@ class MessageReaction(models.Model):
         ('🔥', 'Fire'),
         ('💯', 'Hundred'),
     ]
+    EMOJI_VALUES = frozenset(value for value, _ in EMOJI_CHOICES)
     
     message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='reactions')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -228,12 +621,90 @@ class MessageReaction(models.Model):
     @classmethod
     def toggle_reaction(cls, message, user, emoji):
         """Toggle a reaction - add if doesn't exist, remove if exists"""
-        reaction, created = cls.objects.get_or_create(
-            message=message,
-            user=user,
-            emoji=emoji
-        )
-        if not created:
-            reaction.delete()
-            return None
+        # The counter is updated by signal handlers in the same transaction
+        with transaction.atomic():
+            reaction, created = cls.objects.get_or_create(
+                message=message,
+                user=user,
+                emoji=emoji
+            )
+            if not created:
+                reaction.delete()
+                return None
         return reaction
+    
+    @classmethod
+    def summarize(cls, message_ids, user):
+        """
+        Reaction counts for a page of messages in a single query.
+        
+        Returns ``{message_id: {emoji: {'count': n, 'user_reacted': bool}}}``
+        read from the counter table, without loading the reacting users.
+        """
+        counters = MessageReactionCount.objects.filter(
+            message_id__in=message_ids,
+            count__gt=0
+        ).annotate(
+            user_reacted=Exists(cls.objects.filter(
+                message_id=OuterRef('message_id'),
+                emoji=OuterRef('emoji'),
+                user=user
+            ))
+        ).order_by('id').values_list('message_id', 'emoji', 'count', 'user_reacted')
+        
+        summary = {}
+        for message_id, emoji, count, user_reacted in counters:
+            summary.setdefault(message_id, {})[emoji] = {
+                'count': count,
+                'user_reacted': user_reacted
+            }
+        return summary
+
+
+class MessageReactionCount(models.Model):
+    """Denormalized number of reactions per message and emoji"""
+    message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='reaction_counts')
+    emoji = models.CharField(max_length=10, choices=MessageReaction.EMOJI_CHOICES)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('message', 'emoji')
+    
+    def __str__(self):
+        return f'{self.emoji} x{self.count} on message {self.message_id}'
+    
+    @classmethod
+    def adjust(cls, message_id, emoji, delta):
+        """Add delta to the number of emoji reactions on a message"""
+        if delta > 0:
+            cls.objects.get_or_create(message_id=message_id, emoji=emoji)
+        cls.objects.filter(message_id=message_id, emoji=emoji).update(count=F('count') + delta)
+
+
+class ChunkedUpload(models.Model):
+    """A file being uploaded in chunks; it becomes a ChatMessage after the last one"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True)
+    total_size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    caption = models.TextField(blank=True, help_text="Message text sent along with the file")
+    expected_sha256 = models.CharField(max_length=64, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    message = models.OneToOneField(ChatMessage, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f'{self.file_name} ({self.received}/{self.total_size} bytes) by {self.user.username}'
+    
+    @property
+    def is_complete(self):
+        return self.message_id is not None
+    
+    @property
+    def part_path(self):
+        """Where chunks are appended until the upload is complete"""
+        return os.path.join(settings.MEDIA_ROOT, 'chat_files', self.room.slug, '.uploads', f'{self.id}.part')
@@ -0,0 +1,80 @@
+"""
+Keyset (cursor) pagination for chat message history.
+
+Messages are paged on ``(created_at, id)`` within a room instead of COUNT + OFFSET,
+so fetching a page costs the same no matter how long the room history is.
+A cursor is an opaque string pointing at the oldest message of a page; asking
+for messages "before" it returns the next older page.
+
+Polling for new messages pages forward on ``id`` instead, in capped batches.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(created_at, pk):
+    """Encode a message position as an opaque, URL-safe cursor"""
+    raw = f'{created_at.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back into ``(created_at, pk)``. Raises ValueError if invalid."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        date_part, pk_part = raw.split('|', 1)
+        return datetime.fromisoformat(date_part), int(pk_part)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def clamp_page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Parse a requested page size and keep it within sane bounds"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def history_page(queryset, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return ``(messages, next_cursor)`` for one page of history.
+
+    ``messages`` are the ``limit`` newest rows of ``queryset`` older than the
+    ``before`` cursor, in chronological order. ``next_cursor`` points at the
+    oldest returned message, or is None when there is nothing older.
+    """
+    if before:
+        created_at, pk = decode_cursor(before)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    # Fetch one extra row to find out whether an older page exists
+    rows = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    next_cursor = encode_cursor(rows[0].created_at, rows[0].id) if has_more and rows else None
+    return rows, next_cursor
+
+
+def delta_page(queryset, after, limit=MAX_PAGE_SIZE):
+    """
+    Return ``(rows, has_more)`` for messages with an id greater than ``after``.
+
+    ``rows`` are at most ``limit`` ``.values()`` dicts in id order, ready for
+    ``ChatMessage.dict_from_values``; ``has_more`` says another batch follows.
+    """
+    rows = list(
+        queryset.filter(id__gt=after)
+        .order_by('id')
+        .values(*queryset.model.VALUES_FIELDS)[:limit + 1]
+    )
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,161 @@
+"""
+Write-behind persistence for messages received over WebSocket.
+
+``ChatConsumer`` used to INSERT every message on the sync thread pool as it
+arrived. Messages are now queued in-process and written in batches with
+``bulk_create`` every few milliseconds (or as soon as a batch fills up),
+across all rooms. Each batch is broadcast to its rooms once it is committed,
+so clients still receive every message with its database id.
+
+The queue is bounded: when it is full, ``submit`` waits, which stops the
+consumer from reading its socket until the database catches up. A batch that
+fails to save is retried ``CHAT_WRITE_RETRIES`` times; after that each sender
+is told over its socket that its message was not saved.
+"""
+import asyncio
+import logging
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .models import ChatMessage, ChatRoom
+from .realtime import room_group_name, message_event
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_FLUSH_INTERVAL', 0.02)  # seconds
+QUEUE_SIZE = getattr(settings, 'CHAT_WRITE_QUEUE_SIZE', 1000)
+WRITE_RETRIES = getattr(settings, 'CHAT_WRITE_RETRIES', 3)
+RETRY_DELAY = 0.5  # seconds, doubled after each failed attempt
+
+
+class MessageWriteBuffer:
+    """Bounded queue of pending messages flushed to the database in batches"""
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._loop = None
+        self._queue = None
+        self._task = None
+
+    def _ensure_started(self):
+        """Start the flusher on the running event loop if it isn't running yet"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._queue is None:
+            # A queue belongs to its loop; carry over anything still waiting in the old one
+            pending = self._queue._queue if self._queue is not None else ()
+            self._queue = asyncio.Queue(maxsize=max(self.queue_size, len(pending)))
+            for item in pending:
+                self._queue.put_nowait(item)
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, user, room, content, reply_channel=None):
+        """Queue a message for saving, waiting while the queue is full
+
+        ``user`` and ``room`` are the instances the consumer resolved when the
+        socket connected, so flushing needs no lookups. ``reply_channel`` is
+        told if the message cannot be saved.
+        """
+        self._ensure_started()
+        await self._queue.put((user, room, content, reply_channel))
+
+    async def drain(self):
+        """Wait until every queued message has been written"""
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    async def close(self):
+        """Flush everything still queued and stop the flusher"""
+        await self.drain()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            except Exception:
+                # Keep flushing later batches whatever went wrong with this one
+                logger.exception('Failed to flush a batch of %d chat messages', len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch):
+        channel_layer = get_channel_layer()
+        delay = RETRY_DELAY
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                events = await self._write(batch)
+                break
+            except Exception:
+                logger.exception('Failed to save a batch of %d chat messages (attempt %d)', len(batch), attempt + 1)
+                if attempt < WRITE_RETRIES:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+        else:
+            await self._reject(channel_layer, batch)
+            return
+        for slug, event in events:
+            try:
+                await channel_layer.group_send(room_group_name(slug), event)
+            except Exception:
+                # Saved already; clients that miss it pick it up with their next poll
+                logger.exception('Failed to broadcast message %s to %s', event['message']['id'], slug)
+
+    async def _reject(self, channel_layer, batch):
+        """Tell each sender that their message was dropped"""
+        for _, _, content, reply_channel in batch:
+            if reply_channel is None:
+                continue
+            try:
+                await channel_layer.send(reply_channel, {
+                    'type': 'chat_error',
+                    'error': 'Your message could not be saved. Please send it again.',
+                    'message': content,
+                })
+            except Exception:
+                logger.exception('Failed to notify %s of an unsaved message', reply_channel)
+
+    @database_sync_to_async
+    def _write(self, batch):
+        """Insert a batch with a single query and return the events to send"""
+        # One transaction and fresh instances on every attempt, so a failed one leaves nothing behind
+        with transaction.atomic():
+            created = ChatMessage.objects.bulk_create([
+                ChatMessage(user=user, room=room, message_content=content) for user, room, content, _ in batch
+            ])
+            # bulk_create skips save(), so bump each room's high-water mark and counter here
+            latest = {}
+            counts = Counter()
+            for message in created:
+                latest[message.room] = message
+                counts[message.room_id] += 1
+            for room, message in latest.items():
+                ChatMessage.bump_high_water_mark(room.slug, message.id)
+                ChatRoom.record_messages(room.id, counts[room.id], message.created_at)
+        return [(message.room.slug, message_event(message)) for message in created]
+
+
+# Shared by every consumer in this process
+message_buffer = MessageWriteBuffer()
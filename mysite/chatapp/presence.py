@@ -0,0 +1,394 @@
+"""
+Presence registry fed by WebSocket connections.
+
+Presence used to be a ``UserPresence`` write (plus an online-users read) on
+every 30 second heartbeat of every open tab. With WebSockets the registry
+knows who is connected from ``ChatConsumer.connect``/``disconnect`` and the
+sockets' pings, and:
+
+* pushes join/leave deltas to the room as they happen, counting a user's
+  connections across workers (in Redis when ``CACHE=redis``) so a second
+  tab on another worker keeps them online,
+* expires sockets that stop pinging after ``CHAT_PRESENCE_TTL`` seconds,
+* writes ``UserPresence`` only in periodic batched snapshots, one statement
+  for everyone who came online and one for everyone who left.
+
+Clients without a socket still use the ``update_presence``/``leave_room``
+views. With ``CHAT_PRESENCE_BUFFERED`` those heartbeats are coalesced by
+``HeartbeatBuffer`` and flushed the same way once per interval.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import UserPresence
+from .realtime import room_group_name
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL', 90)  # seconds
+SNAPSHOT_INTERVAL = getattr(settings, 'CHAT_PRESENCE_SNAPSHOT_INTERVAL', 15)  # seconds
+# Re-persist users who stay online so get_online_users' 5 minute cutoff keeps them
+REFRESH_INTERVAL = getattr(settings, 'CHAT_PRESENCE_REFRESH_INTERVAL', 120)  # seconds
+HEARTBEAT_BUFFERED = getattr(settings, 'CHAT_PRESENCE_BUFFERED', True)
+HEARTBEAT_FLUSH_INTERVAL = getattr(settings, 'CHAT_PRESENCE_FLUSH_INTERVAL', 5)  # seconds
+# Flushes a presence change is retried in before it is dropped
+WRITE_RETRIES = getattr(settings, 'CHAT_PRESENCE_RETRIES', 3)
+
+
+def requeue_failed(pending, failed, attempts, retries=WRITE_RETRIES):
+    """Put changes from a failed write back into pending, dropping those out of retries
+
+    ``failed`` and ``pending`` map ``(user_id, room_id)`` to the online flag;
+    newer changes already in ``pending`` win. ``attempts`` counts failures
+    per key and is updated in place.
+    """
+    dropped = 0
+    for key, is_online in failed.items():
+        attempts[key] = attempts.get(key, 0) + 1
+        if attempts[key] > retries:
+            attempts.pop(key)
+            dropped += 1
+            continue
+        pending.setdefault(key, is_online)
+    if dropped:
+        logger.warning('Dropped %d presence changes after %d failed writes', dropped, retries + 1)
+
+
+class LocalPresenceStore:
+    """Live connections per room, as seen by this process alone
+
+    Enough with a single worker, where every socket is connected to it.
+    """
+
+    def __init__(self):
+        # room_id -> {channel_name: (user_id, username)}
+        self._rooms = {}
+
+    def _has_user(self, room_id, user_id):
+        return any(uid == user_id for uid, _ in self._rooms.get(room_id, {}).values())
+
+    async def add(self, room_id, user_id, username, channel_name):
+        """Add or refresh a connection; True if it brought the user online in the room"""
+        connections = self._rooms.setdefault(room_id, {})
+        if channel_name in connections:
+            return False
+        first = not self._has_user(room_id, user_id)
+        connections[channel_name] = (user_id, username)
+        return first
+
+    async def remove(self, room_id, user_id, username, channel_name):
+        """Remove a connection; True if it was the user's last one in the room"""
+        connections = self._rooms.get(room_id, {})
+        if connections.pop(channel_name, None) is None:
+            return False
+        if not connections:
+            self._rooms.pop(room_id, None)
+        return not self._has_user(room_id, user_id)
+
+    async def usernames(self, room_id):
+        return sorted({username for _, username in self._rooms.get(room_id, {}).values()})
+
+    async def expire(self, room_id):
+        # Every connection is local, and the registry expires those itself
+        return []
+
+
+class RedisPresenceStore:
+    """Live connections per room shared by every worker, in Redis sorted sets
+
+    Each room is a sorted set of ``user_id:username:channel_name`` members
+    scored by their last ping, so a user with tabs on several workers stays
+    online until their last connection anywhere closes or stops pinging, and
+    connections of a worker that died expire on their own.
+    """
+
+    def __init__(self, url, ttl=PRESENCE_TTL):
+        self.url = url
+        self.ttl = ttl
+        self._client = None
+        self._loop = None
+
+    @property
+    def client(self):
+        # redis.asyncio connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            import redis.asyncio
+            self._client = redis.asyncio.from_url(self.url, decode_responses=True)
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def key(room_id):
+        return 'chatapp:presence:%s' % room_id
+
+    @staticmethod
+    def member(user_id, username, channel_name):
+        return f'{user_id}:{username}:{channel_name}'
+
+    @staticmethod
+    def has_user(members, user_id):
+        prefix = f'{user_id}:'
+        return any(member.startswith(prefix) for member in members)
+
+    async def add(self, room_id, user_id, username, channel_name):
+        """Add or refresh a connection; True if it brought the user online in the room"""
+        key = self.key(room_id)
+        now = time.time()
+        member = self.member(user_id, username, channel_name)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrangebyscore(key, now - self.ttl, '+inf')
+            pipe.zadd(key, {member: now})
+            pipe.expire(key, self.ttl * 2)
+            live, added, _ = await pipe.execute()
+        return bool(added) and not self.has_user(live, user_id)
+
+    async def remove(self, room_id, user_id, username, channel_name):
+        """Remove a connection; True if it was the user's last live one in the room"""
+        key = self.key(room_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrem(key, self.member(user_id, username, channel_name))
+            pipe.zrangebyscore(key, time.time() - self.ttl, '+inf')
+            removed, live = await pipe.execute()
+        return bool(removed) and not self.has_user(live, user_id)
+
+    async def usernames(self, room_id):
+        live = await self.client.zrangebyscore(self.key(room_id), time.time() - self.ttl, '+inf')
+        return sorted({member.split(':', 2)[1] for member in live})
+
+    async def expire(self, room_id):
+        """Drop connections that stopped pinging (e.g. of a dead worker)
+
+        Returns ``(user_id, username)`` for each user this call took offline;
+        only the worker whose ZREM succeeded reports a connection.
+        """
+        key = self.key(room_id)
+        cutoff = time.time() - self.ttl
+        stale = await self.client.zrangebyscore(key, '-inf', f'({cutoff}')
+        if not stale:
+            return []
+        async with self.client.pipeline(transaction=True) as pipe:
+            for member in stale:
+                pipe.zrem(key, member)
+            pipe.zrangebyscore(key, cutoff, '+inf')
+            *removed, live = await pipe.execute()
+        gone = {}
+        for member, was_removed in zip(stale, removed):
+            user_id, username, _ = member.split(':', 2)
+            if was_removed and not self.has_user(live, int(user_id)):
+                gone[int(user_id)] = username
+        return list(gone.items())
+
+
+def presence_store():
+    """Redis-backed when workers share the Redis cache, else this process only"""
+    if getattr(settings, 'CACHE', 'locmem') == 'redis':
+        return RedisPresenceStore(settings.CACHE_REDIS_URL)
+    return LocalPresenceStore()
+
+
+class PresenceRegistry:
+    """Who is connected to which room
+
+    Sockets connected to this process are tracked here, for pings, expiry
+    and snapshots. Whether a user is online at all, across every worker,
+    and the roster come from the store, so join and leave are only
+    announced for a user's first and last connection anywhere.
+    """
+
+    def __init__(self, store=None, ttl=PRESENCE_TTL, snapshot_interval=SNAPSHOT_INTERVAL,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.store = store or presence_store()
+        self.ttl = ttl
+        self.snapshot_interval = snapshot_interval
+        self.refresh_interval = refresh_interval
+        # room_id -> {channel_name: [user_id, username, last_ping]}
+        self._connections = {}
+        self._room_slugs = {}
+        # (user_id, room_id) -> True (came online) / False (went offline)
+        self._dirty = {}
+        # (user_id, room_id) -> when the user was last written as online
+        self._persisted = {}
+        # (user_id, room_id) -> failed snapshots in a row
+        self._attempts = {}
+        self._loop = None
+        self._task = None
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def online_usernames(self, room_id):
+        """Usernames connected to a room through any worker"""
+        return await self.store.usernames(room_id)
+
+    async def join(self, room, user, channel_name):
+        """Register a socket; announces the user if this is their first one"""
+        self._ensure_started()
+        self._room_slugs[room.id] = room.slug
+        self._connections.setdefault(room.id, {})[channel_name] = [user.id, user.username, time.monotonic()]
+        if await self.store.add(room.id, user.id, user.username, channel_name):
+            await self._went_online(room.id, user.id, user.username)
+
+    async def touch(self, room, user, channel_name):
+        """Record a ping from a socket, registering it again if it had expired"""
+        connection = self._connections.get(room.id, {}).get(channel_name)
+        if connection is None:
+            await self.join(room, user, channel_name)
+            return
+        connection[2] = time.monotonic()
+        # True if another worker had expired this user in the meantime
+        if await self.store.add(room.id, user.id, user.username, channel_name):
+            await self._went_online(room.id, user.id, user.username)
+
+    async def leave(self, room_id, channel_name):
+        """Unregister a socket; announces the user if it was their last one"""
+        connection = self._connections.get(room_id, {}).pop(channel_name, None)
+        if connection is None:
+            return
+        if not self._connections.get(room_id):
+            self._connections.pop(room_id, None)
+        user_id, username, _ = connection
+        if await self.store.remove(room_id, user_id, username, channel_name):
+            await self._went_offline(room_id, user_id, username)
+
+    async def _went_online(self, room_id, user_id, username):
+        self._dirty[user_id, room_id] = True
+        await self._announce(room_id, 'join', username)
+
+    async def _went_offline(self, room_id, user_id, username):
+        self._dirty[user_id, room_id] = False
+        self._persisted.pop((user_id, room_id), None)
+        await self._announce(room_id, 'leave', username)
+
+    async def _announce(self, room_id, action, username):
+        await get_channel_layer().group_send(room_group_name(self._room_slugs[room_id]), {
+            'type': 'presence_update',
+            'action': action,
+            'username': username,
+        })
+
+    async def expire(self):
+        """Drop sockets that have not pinged within the TTL, here and in the store"""
+        cutoff = time.monotonic() - self.ttl
+        stale = [
+            (room_id, channel)
+            for room_id, channels in self._connections.items()
+            for channel, (_, _, last_ping) in channels.items()
+            if last_ping < cutoff
+        ]
+        for room_id, channel in stale:
+            await self.leave(room_id, channel)
+        # Connections other workers left behind, in the rooms this one serves
+        for room_id in list(self._connections):
+            for user_id, username in await self.store.expire(room_id):
+                await self._went_offline(room_id, user_id, username)
+
+    async def snapshot(self):
+        """Persist presence changes to UserPresence in one batch"""
+        now = time.monotonic()
+        for room_id, channels in self._connections.items():
+            for user_id, _, _ in channels.values():
+                persisted = self._persisted.get((user_id, room_id))
+                if persisted is None or now - persisted >= self.refresh_interval:
+                    self._dirty.setdefault((user_id, room_id), True)
+
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        online = [key for key, is_online in dirty.items() if is_online]
+        offline = [key for key, is_online in dirty.items() if not is_online]
+        try:
+            await database_sync_to_async(UserPresence.bulk_set_presence)(online, offline)
+        except Exception:
+            logger.exception('Failed to snapshot presence for %d users', len(dirty))
+            # Retry with the next snapshots unless something newer replaced it
+            requeue_failed(self._dirty, dirty, self._attempts)
+            return
+        for key in dirty:
+            self._attempts.pop(key, None)
+        for key in online:
+            self._persisted[key] = now
+
+    async def close(self):
+        """Write a final snapshot and stop the background task"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.snapshot()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.expire()
+            await self.snapshot()
+
+
+# Shared by every consumer in this process
+presence_registry = PresenceRegistry()
+
+
+class HeartbeatBuffer:
+    """
+    Coalesces HTTP presence heartbeats and flushes them once per interval.
+
+    Only the latest state of each ``(user, room)`` is kept, so a flush is at
+    most one upsert for everyone who is online and one update for everyone
+    who left, however many tabs sent heartbeats in between.
+    """
+
+    def __init__(self, flush_interval=HEARTBEAT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        # (user_id, room_id) -> failed flushes in a row
+        self._attempts = {}
+        self._thread = None
+
+    def record(self, user, room, online=True):
+        """Queue a presence change; called from synchronous views"""
+        with self._lock:
+            self._pending[user.id, room.id] = online
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='presence-heartbeats', daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        """Write every queued change in one batch"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        online = [key for key, is_online in pending.items() if is_online]
+        offline = [key for key, is_online in pending.items() if not is_online]
+        try:
+            UserPresence.bulk_set_presence(online, offline)
+        except Exception:
+            logger.exception('Failed to flush %d presence heartbeats', len(pending))
+            with self._lock:
+                requeue_failed(self._pending, pending, self._attempts)
+            return
+        with self._lock:
+            for key in pending:
+                self._attempts.pop(key, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+# Used by the presence views when CHAT_PRESENCE_BUFFERED is on
+presence_heartbeats = HeartbeatBuffer()
@@ -0,0 +1,198 @@
+"""
+Server-side fan-out of chat events to WebSocket clients.
+
+Views and consumers hand events to the room's channel group; every
+``ChatConsumer`` in the group forwards them to its socket, so clients no
+longer need to poll ``get_messages`` while their WebSocket is open.
+"""
+import asyncio
+import contextvars
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import ChatMessage, MessageReactionCount
+
+REACTION_TICK = getattr(settings, 'CHAT_REACTION_TICK', 0.1)  # seconds
+LONG_POLL_TIMEOUT = getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)  # seconds
+LONG_POLL_MAX_WAITERS = getattr(settings, 'CHAT_LONG_POLL_MAX_WAITERS', 1000)
+
+
+def room_group_name(slug):
+    """Name of the channel group that all sockets in a room join"""
+    return 'chat_%s' % slug
+
+
+def send_to_room(slug, event):
+    """Send an event to every socket in a room from synchronous code"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(room_group_name(slug), event)
+
+
+def message_event(message):
+    """Build the channel layer event for a newly created message"""
+    return {
+        'type': 'chat_message',
+        'message': message.to_dict(),
+    }
+
+
+def broadcast_message(message):
+    """Push a newly created message to the room once it is committed"""
+    slug = message.room.slug
+    event = message_event(message)
+    transaction.on_commit(lambda: send_to_room(slug, event))
+
+
+class ReactionBroadcaster:
+    """
+    Coalesces reaction toggles into at most one event per message per tick.
+
+    Toggles only mark ``(room, message, emoji)`` as dirty. When the tick
+    fires, the current counts for every dirty message are read in one query
+    and sent as a single ``reaction_update`` event per message, so a burst of
+    toggles on a hot message costs each socket one update.
+    """
+
+    def __init__(self, tick=REACTION_TICK):
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._scheduled = False
+
+    def record(self, slug, message_id, emoji):
+        """Mark a reaction as changed; called from synchronous views"""
+        with self._lock:
+            self._pending.setdefault((slug, message_id), set()).add(emoji)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            self._schedule()
+        except Exception:
+            with self._lock:
+                self._scheduled = False
+            raise
+
+    def _schedule(self):
+        # Under ASGI this returns the server's loop, still running; without a
+        # server loop (WSGI, the test client) asgiref runs it on a throwaway one
+        loop = async_to_sync(self._running_loop)()
+        if loop.is_running():
+            # Run detached from the request's context, which ends before the tick
+            loop.call_soon_threadsafe(
+                lambda: loop.call_later(self.tick, lambda: loop.create_task(self.flush())),
+                context=contextvars.Context()
+            )
+        else:
+            timer = threading.Timer(self.tick, self._flush_from_thread)
+            timer.daemon = True
+            timer.start()
+
+    @staticmethod
+    async def _running_loop():
+        return asyncio.get_running_loop()
+
+    def _take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._scheduled = False
+        return pending
+
+    def _build_events(self, pending):
+        counts = {}
+        rows = MessageReactionCount.objects.filter(
+            message_id__in=[message_id for _, message_id in pending]
+        ).values_list('message_id', 'emoji', 'count')
+        for message_id, emoji, count in rows:
+            counts[message_id, emoji] = count
+
+        return [
+            (slug, {
+                'type': 'reaction_update',
+                'message_id': message_id,
+                'counts': {emoji: max(counts.get((message_id, emoji), 0), 0) for emoji in emojis},
+            })
+            for (slug, message_id), emojis in pending.items()
+        ]
+
+    async def flush(self):
+        pending = self._take_pending()
+        if not pending:
+            return
+        channel_layer = get_channel_layer()
+        for slug, event in await database_sync_to_async(self._build_events)(pending):
+            await channel_layer.group_send(room_group_name(slug), event)
+
+    def _flush_from_thread(self):
+        try:
+            pending = self._take_pending()
+            if pending:
+                for slug, event in self._build_events(pending):
+                    send_to_room(slug, event)
+        finally:
+            close_old_connections()
+
+
+reaction_broadcaster = ReactionBroadcaster()
+
+
+class RoomWaiters:
+    """
+    Long-poll requests parked on room groups in this process.
+
+    Each waiter listens on a fresh channel in the room's group, so it is
+    woken by the same ``chat_message`` events that reach WebSocket clients.
+    At most ``max_waiters`` requests are parked at once; beyond that callers
+    are told to answer straight away, like a normal poll.
+    """
+
+    def __init__(self, max_waiters=LONG_POLL_MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self.count = 0
+
+    async def wait(self, room, last_message_id, timeout=LONG_POLL_TIMEOUT):
+        """Wait for a message newer than last_message_id
+
+        Returns False if the process already has too many parked requests,
+        otherwise True once a message arrived or the timeout passed.
+        """
+        if self.count >= self.max_waiters:
+            return False
+        channel_layer = get_channel_layer()
+        group = room_group_name(room.slug)
+        channel = await channel_layer.new_channel()
+
+        self.count += 1
+        await channel_layer.group_add(group, channel)
+        try:
+            # A message may have landed between the caller's check and joining
+            high_water = await ChatMessage.ahigh_water_mark(room.slug)
+            if high_water is None:
+                high_water = await database_sync_to_async(ChatMessage.refresh_high_water_mark)(room)
+            if high_water > last_message_id:
+                return True
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + timeout
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return True
+                try:
+                    event = await asyncio.wait_for(channel_layer.receive(channel), remaining)
+                except asyncio.TimeoutError:
+                    return True
+                if event.get('type') == 'chat_message' and event['message']['id'] > last_message_id:
+                    return True
+        finally:
+            self.count -= 1
+            await channel_layer.group_discard(group, channel)
+
+
+room_waiters = RoomWaiters()
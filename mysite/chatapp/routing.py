@@ -1,7 +1,13 @@
+from channels.auth import AuthMiddlewareStack
 from django.urls import path
 
 from .import consumers
 
 websocket_urlpatterns = [
     path('ws/<str:room_name>/',consumers.ChatConsumer.as_asgi()),
-]
\ No newline at end of file
+]
+
+# Served by mysite.asgi ahead of Django's own URLs
+http_urlpatterns = [
+    path('rooms/<slug:slug>/messages/wait/', AuthMiddlewareStack(consumers.MessageLongPollConsumer.as_asgi())),
+]
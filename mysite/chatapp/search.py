@@ -0,0 +1,191 @@
+"""
+Full-text search over chat messages.
+
+The backend follows the database:
+
+* PostgreSQL matches ``to_tsvector('simple', message_content)`` against a
+  prefix ``tsquery``; the expression has a GIN index
+  (``chatmsg_content_fts_idx``), so nothing is stored besides the index.
+* SQLite queries the ``chatapp_chatmessage_fts`` FTS5 table, an external
+  content index over ``chatapp_chatmessage`` that triggers keep in sync on
+  every insert, update and delete, ``bulk_create`` included.
+* Any other database falls back to one ``icontains`` per word.
+
+Every word of the query must appear in a message, each as a word prefix.
+Results are newest first and paged with the same opaque ``(created_at, id)``
+cursors as the message history, so a page costs the same however deep it is.
+Highlights are HTML: the message is escaped and matches are wrapped in
+``<mark>``.
+"""
+import functools
+import re
+
+from django.db import connections, router
+from django.db.models import BooleanField, CharField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+
+from .models import ChatMessage
+from .pagination import DEFAULT_PAGE_SIZE, decode_cursor, encode_cursor
+
+FTS_TABLE = 'chatapp_chatmessage_fts'
+MAX_QUERY_LENGTH = 200
+MAX_TERMS = 10
+
+# Highlight boundaries the databases put around matches, turned into <mark> once escaped
+START_SEL = '\x02'
+STOP_SEL = '\x03'
+
+WORD_RE = re.compile(r'\w+')
+
+# Recreated after every migrate: SQLite drops a table's triggers whenever
+# Django rebuilds the table to alter a column.
+SQLITE_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON chatapp_chatmessage BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, message_content) VALUES (new.id, new.message_content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON chatapp_chatmessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_content)
+        VALUES ('delete', old.id, old.message_content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF message_content ON chatapp_chatmessage BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_content)
+        VALUES ('delete', old.id, old.message_content);
+        INSERT INTO {FTS_TABLE}(rowid, message_content) VALUES (new.id, new.message_content);
+    END""",
+]
+
+
+def search_terms(query):
+    """The words of a search query, lowercased, in order and without repeats"""
+    words = WORD_RE.findall(query[:MAX_QUERY_LENGTH].lower())
+    return list(dict.fromkeys(words))[:MAX_TERMS]
+
+
+def mark_highlights(text):
+    """Escape text and wrap the spans between START_SEL and STOP_SEL in <mark>"""
+    return escape(text).replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>')
+
+
+class PostgresSearchBackend:
+    """tsvector/tsquery search served by the GIN expression index"""
+
+    # Must stay identical to the indexed expression for the index to be used
+    vector = "to_tsvector('simple', \"chatapp_chatmessage\".\"message_content\")"
+
+    def tsquery(self, terms):
+        return ' & '.join(f"'{term}':*" for term in terms)
+
+    def filter(self, queryset, terms):
+        return queryset.filter(RawSQL(
+            f"{self.vector} @@ to_tsquery('simple', %s)", [self.tsquery(terms)], output_field=BooleanField()
+        ))
+
+    def annotate_highlight(self, queryset, terms):
+        return queryset.annotate(highlight=RawSQL(
+            "ts_headline('simple', \"chatapp_chatmessage\".\"message_content\", to_tsquery('simple', %s), %s)",
+            [self.tsquery(terms), f'StartSel={START_SEL}, StopSel={STOP_SEL}, MaxWords=35, MinWords=15'],
+            output_field=CharField()
+        ))
+
+    def highlight(self, message, terms):
+        return mark_highlights(message.highlight)
+
+
+class SQLiteSearchBackend:
+    """FTS5 search through the trigger-maintained chatapp_chatmessage_fts table"""
+
+    def match(self, terms):
+        # Each term as a quoted prefix; FTS5 ANDs space separated phrases
+        return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    def filter(self, queryset, terms):
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.match(terms)]
+        ))
+
+    def annotate_highlight(self, queryset, terms):
+        return queryset.annotate(highlight=RawSQL(
+            f'SELECT snippet({FTS_TABLE}, 0, %s, %s, %s, 32) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = "chatapp_chatmessage"."id"',
+            [START_SEL, STOP_SEL, '…', self.match(terms)],
+            output_field=CharField()
+        ))
+
+    def highlight(self, message, terms):
+        return mark_highlights(message.highlight)
+
+
+class FallbackSearchBackend:
+    """Substring search for databases without a full-text index here"""
+
+    def filter(self, queryset, terms):
+        for term in terms:
+            queryset = queryset.filter(message_content__icontains=term)
+        return queryset
+
+    def annotate_highlight(self, queryset, terms):
+        return queryset
+
+    def highlight(self, message, terms):
+        pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+        return mark_highlights(pattern.sub(lambda m: START_SEL + m.group() + STOP_SEL, message.message_content))
+
+
+def sqlite_has_fts(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_backend(alias='default'):
+    """The search backend for a database connection"""
+    connection = connections[alias]
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if connection.vendor == 'sqlite' and sqlite_has_fts(connection):
+        return SQLiteSearchBackend()
+    return FallbackSearchBackend()
+
+
+def ensure_search_triggers(sender=None, using='default', **kwargs):
+    """post_migrate: put back FTS triggers lost when SQLite rebuilt the message table"""
+    get_search_backend.cache_clear()
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not sqlite_has_fts(connection):
+        return
+    with connection.cursor() as cursor:
+        for statement in SQLITE_TRIGGERS:
+            cursor.execute(statement)
+
+
+def search_messages(queryset, query, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return ``(messages, next_cursor)`` for one page of search results.
+
+    ``messages`` are the ``limit`` newest rows of ``queryset`` matching
+    ``query`` and older than the ``before`` cursor, newest first, each with a
+    ``search_highlight``. ``next_cursor`` points at the last one, or is None
+    when there are no more results. Raises ValueError for an empty query or a
+    bad cursor.
+    """
+    terms = search_terms(query or '')
+    if not terms:
+        raise ValueError('Enter at least one word to search for.')
+
+    backend = get_search_backend(router.db_for_read(ChatMessage))
+    queryset = backend.filter(queryset, terms)
+    if before:
+        created_at, pk = decode_cursor(before)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    # Fetch one extra row to find out whether another page exists
+    rows = list(backend.annotate_highlight(queryset, terms).order_by('-created_at', '-id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    for message in rows:
+        message.search_highlight = backend.highlight(message, terms)
+
+    next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None
+    return rows, next_cursor
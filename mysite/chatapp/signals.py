@@ -0,0 +1,109 @@
+"""
+Signal handlers for the chat app.
+
+Attachment reference counts, room message counters, reaction counters,
+cached room access and the cached room directory are kept here rather than in the models' ``save``
+and ``delete`` because deleting a room, a user or a
+queryset removes rows without calling ``delete()``; ``post_delete`` still
+fires for each of them.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .access import invalidate_room, invalidate_room_access, missing_codes
+from .directory import invalidate_directory
+from .models import Attachment, ChatMessage, ChatRoom, MessageReaction, MessageReactionCount, PrivateRoomMembership
+
+
+@receiver(post_save, sender=ChatMessage)
+def reference_attachment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.attachment_id:
+        Attachment.add_reference(instance.attachment_id)
+
+
+@receiver(post_delete, sender=ChatMessage)
+def release_attachment(sender, instance, **kwargs):
+    if instance.attachment_id:
+        Attachment.release(instance.attachment_id)
+
+
+def deleted_with(origin, *models):
+    """Whether a post_delete comes from deleting one of models (or a queryset of them)"""
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model in models
+
+
+@receiver(post_delete, sender=ChatMessage)
+def uncount_message(sender, instance, origin=None, **kwargs):
+    # A room being deleted takes its counter with it
+    if deleted_with(origin, ChatRoom):
+        return
+    if isinstance(origin, ChatMessage):
+        ChatRoom.record_messages(instance.room_id, -1)
+        return
+    # Queryset and cascade deletes: tally on the object delete() was called on,
+    # then one UPDATE per room once the delete is committed
+    uncounted = getattr(origin, '_uncounted_messages', None)
+    if uncounted is None:
+        uncounted = origin._uncounted_messages = Counter()
+        transaction.on_commit(lambda: [
+            ChatRoom.record_messages(room_id, -count) for room_id, count in uncounted.items()
+        ])
+    uncounted[instance.room_id] += 1
+
+
+@receiver(post_save, sender=MessageReaction)
+def count_reaction(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        MessageReactionCount.adjust(instance.message_id, instance.emoji, 1)
+
+
+@receiver(post_delete, sender=MessageReaction)
+def uncount_reaction(sender, instance, origin=None, **kwargs):
+    # The counters of deleted messages are deleted along with them
+    if not deleted_with(origin, ChatMessage, ChatRoom):
+        MessageReactionCount.adjust(instance.message_id, instance.emoji, -1)
+
+
+@receiver(post_save, sender=PrivateRoomMembership)
+@receiver(post_delete, sender=PrivateRoomMembership)
+def membership_changed(sender, instance, **kwargs):
+    invalidate_room_access(instance.user_id)
+
+
+@receiver(pre_save, sender=ChatRoom)
+def remember_room_owner(sender, instance, raw=False, **kwargs):
+    # An owner or type change must also reach the previous owner's cache,
+    # and a slug change the room cached under the old slug
+    instance._previous_owner_id = instance._previous_slug = None
+    if instance.pk and not raw:
+        previous = ChatRoom.objects.filter(pk=instance.pk).values_list('owner_id', 'slug').first()
+        if previous:
+            instance._previous_owner_id, instance._previous_slug = previous
+
+
+@receiver(post_save, sender=ChatRoom)
+def room_saved(sender, instance, created, **kwargs):
+    invalidate_directory()
+    invalidate_room(instance.slug, getattr(instance, '_previous_slug', None))
+    if instance.access_code:
+        # The code may have been guessed before the room existed
+        missing_codes.discard(instance.access_code)
+    if created:
+        if instance.room_type == 'private':
+            invalidate_room_access(instance.owner_id)
+        return
+    member_ids = PrivateRoomMembership.objects.filter(room=instance).values_list('user_id', flat=True)
+    invalidate_room_access(instance.owner_id, getattr(instance, '_previous_owner_id', None), *member_ids)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_deleted(sender, instance, **kwargs):
+    invalidate_directory()
+    invalidate_room(instance.slug)
+    # Members are invalidated as their memberships are deleted with the room
+    invalidate_room_access(instance.owner_id)
@@ -0,0 +1,77 @@
+"""
+Content-addressed storage for chat attachments.
+
+Every distinct file is written once, at a name derived from the SHA-256 of
+its bytes: ``chat_files/blobs/<first two hex digits>/<sha256><ext>``. Posting
+the same file again, in any room, finds the blob already there and writes
+nothing, and names never collide so they never need random suffixes. Which
+messages use a blob is tracked by ``Attachment.ref_count``.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+BLOB_PREFIX = 'chat_files/blobs'
+
+
+@deconstructible(path='chatapp.storage.ContentAddressedStorage')
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names each file after the hash of its content"""
+
+    def blob_name(self, digest, extension=''):
+        extension = extension.lower()
+        if not re.fullmatch(r'\.[a-z0-9]{1,10}', extension):
+            extension = ''
+        return f'{BLOB_PREFIX}/{digest[:2]}/{digest}{extension}'
+
+    @staticmethod
+    def digest_of(name):
+        """SHA-256 a blob name was derived from"""
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def get_available_name(self, name, max_length=None):
+        # The same name always means the same bytes, so an existing file is reused, not renamed
+        return name
+
+    def _save(self, name, content):
+        """Stream content to a temporary file while hashing it, then move it into place"""
+        temp_dir = self.path(f'{BLOB_PREFIX}/.tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+
+        hasher = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    hasher.update(chunk)
+                    temp.write(chunk)
+            return self.adopt(temp_path, hasher.hexdigest(), os.path.splitext(name)[1])
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def adopt(self, path, digest, extension=''):
+        """Move a local file whose SHA-256 is already known into the store and return its name"""
+        name = self.blob_name(digest, extension)
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            os.remove(path)
+            return name
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Atomic, and harmless if another request stored the same bytes meanwhile
+        os.replace(path, full_path)
+        # mkstemp files are private; blobs need to be readable by whatever serves MEDIA_ROOT
+        os.chmod(full_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        return name
+
+
+attachment_storage = ContentAddressedStorage()
@@ -1,3 +1,962 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import shutil
+import tempfile
+from collections import OrderedDict
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .access import missing_codes
+from .admin import UserBlockAdmin
+from .directory import directory_page
+from .media_views import parse_range
+from .middleware import SessionRefreshMiddleware
+from .models import (
+    ACCESS_CODE_ATTEMPTS, Attachment, ChatMessage, ChatRoom, ChunkedUpload, MessageReaction, MessageReactionCount,
+    PrivateRoomMembership, UserBlock, UserPresence,
+)
+from .persistence import MessageWriteBuffer
+from .presence import WRITE_RETRIES, HeartbeatBuffer, LocalPresenceStore, PresenceRegistry
+from .search import FTS_TABLE, SQLiteSearchBackend, ensure_search_triggers, get_search_backend, search_messages
+from .storage import attachment_storage
+
+
+class ReactionCountTests(TestCase):
+    """The denormalized counters follow reactions however they are deleted"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.owner)
+        self.message = ChatMessage.objects.create(user=self.owner, room=self.room, message_content='hi')
+
+    def count(self, emoji='👍', message=None):
+        counter = MessageReactionCount.objects.filter(message=message or self.message, emoji=emoji).first()
+        return counter.count if counter else 0
+
+    def test_toggle_adds_and_removes(self):
+        MessageReaction.toggle_reaction(self.message, self.alice, '👍')
+        MessageReaction.toggle_reaction(self.message, self.bob, '👍')
+        self.assertEqual(self.count(), 2)
+
+        MessageReaction.toggle_reaction(self.message, self.alice, '👍')
+        self.assertEqual(self.count(), 1)
+
+    def test_deleting_a_user_uncounts_their_reactions(self):
+        other = ChatMessage.objects.create(user=self.owner, room=self.room, message_content='again')
+        for message in (self.message, other):
+            MessageReaction.toggle_reaction(message, self.alice, '🔥')
+            MessageReaction.toggle_reaction(message, self.bob, '🔥')
+
+        self.alice.delete()
+
+        self.assertEqual(self.count('🔥'), 1)
+        self.assertEqual(self.count('🔥', other), 1)
+
+    def test_queryset_delete_uncounts_reactions(self):
+        MessageReaction.toggle_reaction(self.message, self.alice, '🎉')
+        MessageReaction.toggle_reaction(self.message, self.bob, '🎉')
+        MessageReaction.toggle_reaction(self.message, self.bob, '❤️')
+
+        MessageReaction.objects.filter(user=self.bob).delete()
+
+        self.assertEqual(self.count('🎉'), 1)
+        self.assertEqual(self.count('❤️'), 0)
+
+    def test_deleting_a_message_takes_its_counters(self):
+        MessageReaction.toggle_reaction(self.message, self.alice, '👍')
+
+        self.message.delete()
+
+        self.assertFalse(MessageReactionCount.objects.exists())
+
+    def test_deleting_a_room_does_not_touch_other_rooms(self):
+        other_room = ChatRoom.objects.create(name='Other', slug='other', owner=self.owner)
+        kept = ChatMessage.objects.create(user=self.owner, room=other_room, message_content='stay')
+        MessageReaction.toggle_reaction(self.message, self.alice, '👍')
+        MessageReaction.toggle_reaction(kept, self.alice, '👍')
+
+        self.room.delete()
+
+        self.assertEqual(self.count(message=kept), 1)
+        self.assertEqual(list(MessageReactionCount.objects.values_list('message_id', flat=True)), [kept.id])
+
+
+@mock.patch('chatapp.views.reaction_broadcaster', mock.Mock())
+class ReactionViewTests(TestCase):
+    """Only the offered emoji can be posted as reactions"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.user)
+        self.message = ChatMessage.objects.create(user=self.user, room=self.room, message_content='hi')
+        self.url = reverse('toggle_reaction', args=[self.room.slug, self.message.id])
+        self.client.force_login(self.user)
+
+    def test_listed_emoji_is_toggled(self):
+        response = self.client.post(self.url, {'emoji': '🎉'})
+        self.assertEqual(response.json()['reaction_counts'], {'🎉': {'count': 1, 'user_reacted': True}})
+
+    def test_unknown_reaction_is_rejected(self):
+        for emoji in ('<img src=x onerror=alert(1)>', ''):
+            with self.subTest(emoji=emoji):
+                self.assertEqual(self.client.post(self.url, {'emoji': emoji}).status_code, 400)
+        self.assertFalse(MessageReaction.objects.exists())
+
+
+# The reaction and heartbeat buffers flush from their own threads, outside the test transaction
+@mock.patch('chatapp.views.presence_heartbeats', mock.Mock())
+@mock.patch('chatapp.views.reaction_broadcaster', mock.Mock())
+class RoomAccessTests(TestCase):
+    """Every view that reads or writes a private room checks membership"""
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.member = User.objects.create_user('member')
+        self.outsider = User.objects.create_user('outsider')
+        self.room = ChatRoom.objects.create(name='Secret', slug='secret', owner=self.owner, room_type='private')
+        PrivateRoomMembership.objects.create(user=self.member, room=self.room)
+        self.message = ChatMessage.objects.create(user=self.owner, room=self.room, message_content='hush')
+
+    def requests(self):
+        slug = self.room.slug
+        return [
+            ('post', reverse('send_message', args=[slug]), {'message': 'hello'}),
+            ('post', reverse('toggle_reaction', args=[slug, self.message.id]), {'emoji': '👍'}),
+            ('post', reverse('update_presence', args=[slug]), {}),
+            ('post', reverse('leave_room', args=[slug]), {}),
+            ('post', reverse('start_upload', args=[slug]), {'file_name': 'a.txt', 'file_size': 3}),
+            ('get', reverse('get_messages', args=[slug]), {'last_message_id': 0}),
+        ]
+
+    def test_outsider_is_refused(self):
+        self.client.force_login(self.outsider)
+        for method, url, data in self.requests():
+            with self.subTest(url=url):
+                response = getattr(self.client, method)(url, data)
+                self.assertEqual(response.status_code, 403)
+
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertFalse(MessageReaction.objects.exists())
+
+    def test_member_is_let_in(self):
+        self.client.force_login(self.member)
+        for method, url, data in self.requests():
+            with self.subTest(url=url):
+                response = getattr(self.client, method)(url, data)
+                self.assertIn(response.status_code, (200, 201))
+
+        self.assertEqual(ChatMessage.objects.filter(user=self.member).count(), 1)
+
+    def test_outsider_cannot_probe_the_poll_shortcut(self):
+        # The cached high-water mark must not answer before access is checked
+        self.client.force_login(self.outsider)
+        with mock.patch('chatapp.models.HIGH_WATER_CACHE', True):
+            ChatMessage.refresh_high_water_mark(self.room)
+            response = self.client.get(reverse('get_messages', args=[self.room.slug]), {'last_message_id': self.message.id})
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn('ETag', response)
+
+
+class PollDeltaTests(TestCase):
+    """get_messages returns what is newer than the client's last id, one capped batch at a time"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+        self.url = reverse('get_messages', args=[self.room.slug])
+        self.client.force_login(self.alice)
+
+    def post(self, count):
+        return [
+            ChatMessage.objects.create(user=self.alice, room=self.room, message_content=f'm{i}').id
+            for i in range(count)
+        ]
+
+    def test_only_newer_messages_are_returned(self):
+        ids = self.post(3)
+        data = self.client.get(self.url, {'last_message_id': ids[0]}).json()
+        self.assertEqual([m['id'] for m in data['messages']], ids[1:])
+        self.assertEqual(data['messages'][0]['username'], 'alice')
+        self.assertEqual(data['last_message_id'], ids[-1])
+        self.assertFalse(data['has_more'])
+
+    def test_batches_are_capped(self):
+        ids = self.post(5)
+        data = self.client.get(self.url, {'last_message_id': 0, 'limit': 2}).json()
+        self.assertEqual([m['id'] for m in data['messages']], ids[:2])
+        self.assertTrue(data['has_more'])
+
+        data = self.client.get(self.url, {'last_message_id': data['last_message_id'], 'limit': 1000}).json()
+        self.assertEqual([m['id'] for m in data['messages']], ids[2:])
+        self.assertFalse(data['has_more'])
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        self.post(2)
+        self.client.get(self.url, {'last_message_id': 0})  # fills the room and access caches
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, {'last_message_id': 0})
+        self.post(20)
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(self.url, {'last_message_id': 0})
+        self.assertEqual(len(large), len(small))
+
+    def test_bad_last_message_id(self):
+        response = self.client.get(self.url, {'last_message_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch('chatapp.models.HIGH_WATER_CACHE', True)
+class PollHighWaterTests(TestCase):
+    """Idle polls are answered from the room's cached newest message id"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+        self.message = ChatMessage.objects.create(user=self.alice, room=self.room, message_content='first')
+        self.url = reverse('get_messages', args=[self.room.slug])
+        self.client.force_login(self.alice)
+
+    def poll(self, last_message_id, client=None, **headers):
+        return (client or self.client).get(self.url, {'last_message_id': last_message_id}, headers=headers)
+
+    def test_catching_up_fills_the_mark(self):
+        response = self.poll(0)
+        self.assertEqual([m['id'] for m in response.json()['messages']], [self.message.id])
+        self.assertEqual(ChatMessage.high_water_mark(self.room.slug), self.message.id)
+
+    def test_idle_poll_skips_the_message_table(self):
+        ChatMessage.refresh_high_water_mark(self.room)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.poll(self.message.id)
+        self.assertEqual(response.json()['messages'], [])
+        self.assertIn('ETag', response)
+        self.assertFalse([q for q in queries if 'chatapp_chatmessage' in q['sql']])
+
+    def test_repeated_poll_is_not_modified(self):
+        ChatMessage.refresh_high_water_mark(self.room)
+        etag = self.poll(self.message.id)['ETag']
+
+        response = self.poll(self.message.id, if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_is_tied_to_the_session(self):
+        ChatMessage.refresh_high_water_mark(self.room)
+        etag = self.poll(self.message.id)['ETag']
+
+        other = self.client_class()
+        other.force_login(self.bob)
+        response = self.poll(self.message.id, client=other, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_new_message_moves_the_mark(self):
+        ChatMessage.refresh_high_water_mark(self.room)
+        etag = self.poll(self.message.id)['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            newer = ChatMessage.objects.create(user=self.bob, room=self.room, message_content='second')
+
+        response = self.poll(self.message.id, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.json()['messages']], [newer.id])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_mark_is_off_without_a_shared_cache(self):
+        with mock.patch('chatapp.models.HIGH_WATER_CACHE', False):
+            ChatMessage.refresh_high_water_mark(self.room)
+            self.assertIsNone(ChatMessage.high_water_mark(self.room.slug))
+            response = self.poll(self.message.id)
+        self.assertNotIn('ETag', response)
+
+
+class FakeChannelLayer:
+    """Records what is sent; group_send fails as many times as asked"""
+
+    def __init__(self, group_send_failures=0):
+        self.group_send_failures = group_send_failures
+        self.group_sends = []
+        self.sends = []
+
+    async def group_send(self, group, event):
+        if self.group_send_failures:
+            self.group_send_failures -= 1
+            raise ConnectionError('channel layer down')
+        self.group_sends.append((group, event))
+
+    async def send(self, channel, event):
+        self.sends.append((channel, event))
+
+
+@mock.patch('chatapp.persistence.RETRY_DELAY', 0)
+class MessageWriteBufferTests(TestCase):
+    """Messages queued by the consumer are saved once, or their senders are told"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.user)
+        self.layer = FakeChannelLayer()
+        patcher = mock.patch('chatapp.persistence.get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def saved(self):
+        return list(ChatMessage.objects.order_by('id').values_list('message_content', flat=True))
+
+    async def submit_all(self, buffer, contents):
+        for content in contents:
+            await buffer.submit(self.user, self.room, content, 'reply.channel')
+        await buffer.close()
+
+    async def test_batch_is_saved_and_broadcast(self):
+        await self.submit_all(MessageWriteBuffer(), ['m0', 'm1'])
+
+        self.assertEqual(await database_sync_to_async(self.saved)(), ['m0', 'm1'])
+        self.assertEqual([event['message']['message'] for _, event in self.layer.group_sends], ['m0', 'm1'])
+
+    async def test_failed_attempt_is_retried_without_duplicates(self):
+        # The insert succeeds but the counter update after it fails once
+        with mock.patch.object(ChatRoom, 'record_messages', side_effect=[RuntimeError('db down'), None]):
+            await self.submit_all(MessageWriteBuffer(), ['once'])
+
+        self.assertEqual(await database_sync_to_async(self.saved)(), ['once'])
+        self.assertEqual(len(self.layer.group_sends), 1)
+
+    @mock.patch('chatapp.persistence.WRITE_RETRIES', 1)
+    async def test_sender_is_told_when_saving_keeps_failing(self):
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=RuntimeError('db down')):
+            await self.submit_all(MessageWriteBuffer(), ['lost'])
+
+        self.assertEqual(await database_sync_to_async(self.saved)(), [])
+        self.assertEqual(self.layer.group_sends, [])
+        [(channel, event)] = self.layer.sends
+        self.assertEqual((channel, event['type'], event['message']), ('reply.channel', 'chat_error', 'lost'))
+
+    async def test_failed_broadcast_keeps_the_queue(self):
+        self.layer.group_send_failures = 1
+        contents = [f'm{i}' for i in range(5)]
+        await self.submit_all(MessageWriteBuffer(batch_size=1), contents)
+
+        self.assertEqual(await database_sync_to_async(self.saved)(), contents)
+        self.assertEqual(len(self.layer.group_sends), 4)
+
+    async def test_restarted_flusher_keeps_queued_messages(self):
+        buffer = MessageWriteBuffer()
+        buffer._ensure_started()
+        buffer._task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await buffer._task
+        buffer._queue.put_nowait((self.user, self.room, 'queued', None))
+
+        await self.submit_all(buffer, ['next'])
+
+        self.assertEqual(await database_sync_to_async(self.saved)(), ['queued', 'next'])
+
+
+# Flushed by hand instead of from the buffer's thread
+@mock.patch.object(HeartbeatBuffer, '_run', lambda self: None)
+class HeartbeatBufferTests(TestCase):
+    """Buffered HTTP heartbeats survive rooms and users deleted before the flush"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.lobby = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+        self.gone = ChatRoom.objects.create(name='Gone', slug='gone', owner=self.alice)
+        self.buffer = HeartbeatBuffer()
+
+    def online(self):
+        return set(UserPresence.objects.filter(is_online=True).values_list('user__username', 'room__slug'))
+
+    def test_deleted_room_does_not_block_the_batch(self):
+        self.buffer.record(self.alice, self.lobby)
+        self.buffer.record(self.bob, self.gone)
+        self.gone.delete()
+
+        self.buffer.flush()
+
+        self.assertEqual(self.online(), {('alice', 'lobby')})
+        self.buffer.record(self.bob, self.lobby)
+        self.buffer.flush()
+        self.assertEqual(self.online(), {('alice', 'lobby'), ('bob', 'lobby')})
+
+    def test_failing_changes_are_dropped_after_the_retries(self):
+        self.buffer.record(self.alice, self.lobby)
+        with mock.patch.object(UserPresence, 'bulk_set_presence', side_effect=RuntimeError('db down')) as write:
+            for _ in range(WRITE_RETRIES + 2):
+                self.buffer.flush()
+        self.assertEqual(write.call_count, WRITE_RETRIES + 1)
+
+        self.buffer.flush()
+        self.assertEqual(self.online(), set())
+
+
+class PresenceSnapshotTests(TestCase):
+    """Socket presence snapshots keep going when a room is deleted under them"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.lobby = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+        self.gone = ChatRoom.objects.create(name='Gone', slug='gone', owner=self.alice)
+        self.registry = PresenceRegistry(store=LocalPresenceStore())
+        patcher = mock.patch('chatapp.presence.get_channel_layer', return_value=FakeChannelLayer())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await self.registry.close()
+
+    def online(self):
+        return set(UserPresence.objects.filter(is_online=True).values_list('user__username', 'room__slug'))
+
+    async def test_deleted_room_does_not_block_snapshots(self):
+        await self.registry.join(self.lobby, self.alice, 'socket.a')
+        await self.registry.join(self.gone, self.bob, 'socket.b')
+        await database_sync_to_async(self.gone.delete)()
+
+        await self.registry.snapshot()
+        self.assertEqual(await database_sync_to_async(self.online)(), {('alice', 'lobby')})
+
+        await self.registry.join(self.lobby, self.bob, 'socket.c')
+        await self.registry.snapshot()
+        self.assertEqual(await database_sync_to_async(self.online)(), {('alice', 'lobby'), ('bob', 'lobby')})
+
+    async def test_failing_changes_are_dropped_after_the_retries(self):
+        await self.registry.join(self.lobby, self.alice, 'socket.a')
+        await self.registry.leave(self.lobby.id, 'socket.a')
+        with mock.patch.object(UserPresence, 'bulk_set_presence', side_effect=RuntimeError('db down')) as write:
+            for _ in range(WRITE_RETRIES + 2):
+                await self.registry.snapshot()
+        self.assertEqual(write.call_count, WRITE_RETRIES + 1)
+
+
+class UserBlockAdminTests(TestCase):
+    """Admin bulk actions clear the cached block status of the users they change"""
+
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser('admin')
+        self.user = User.objects.create_user('alice')
+        self.block = UserBlock.objects.create(
+            user=self.user, blocked_by=self.admin_user, reason='spam',
+            blocked_until=timezone.now() + timezone.timedelta(days=1),
+        )
+        self.model_admin = UserBlockAdmin(UserBlock, AdminSite())
+        self.request = RequestFactory().post('/')
+        self.request.user = self.admin_user
+        self.model_admin.message_user = mock.Mock()
+
+    def test_unblock_on_a_filtered_changelist(self):
+        self.assertIsNotNone(UserBlock.is_user_blocked(self.user))
+
+        # As when the changelist is filtered on "active"
+        self.model_admin.unblock_users(self.request, UserBlock.objects.filter(is_active=True))
+
+        self.assertIsNone(UserBlock.is_user_blocked(self.user))
+
+    def test_make_permanent_on_a_filtered_changelist(self):
+        self.assertEqual(UserBlock.is_user_blocked(self.user).block_type, 'temporary')
+
+        self.model_admin.make_permanent(self.request, UserBlock.objects.filter(block_type='temporary'))
+
+        self.assertEqual(UserBlock.is_user_blocked(self.user).block_type, 'permanent')
+
+
+class MediaRootMixin:
+    """Stores files in a temporary MEDIA_ROOT removed after each test"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    """Uploads resume at the server's offset and are posted only for allowed senders"""
+
+    data = b'0123456789' * 3
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.member = User.objects.create_user('member')
+        self.room = ChatRoom.objects.create(name='Secret', slug='secret', owner=self.owner, room_type='private')
+        self.membership = PrivateRoomMembership.objects.create(user=self.member, room=self.room)
+        self.client.force_login(self.member)
+
+    def start(self, **extra):
+        response = self.client.post(reverse('start_upload', args=[self.room.slug]), {
+            'file_name': 'notes.bin', 'file_size': len(self.data), **extra,
+        })
+        self.assertEqual(response.status_code, 201)
+        return response.json()['upload_id']
+
+    def send(self, upload_id, offset, size=10):
+        url = reverse('upload_chunk', args=[self.room.slug, upload_id])
+        return self.client.post(url, self.data[offset:offset + size], content_type='application/octet-stream',
+                                headers={'Upload-Offset': str(offset)})
+
+    def status(self, upload_id):
+        return self.client.get(reverse('upload_status', args=[self.room.slug, upload_id])).json()
+
+    def test_resume_from_the_reported_offset(self):
+        upload_id = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(self.send(upload_id, 0).json()['offset'], 10)
+
+        # A repeated or skipped chunk is refused with the offset to resume from
+        for offset in (0, 20):
+            response = self.send(upload_id, offset)
+            self.assertEqual((response.status_code, response.json()['offset']), (409, 10))
+
+        self.assertEqual(self.status(upload_id)['offset'], 10)
+        self.send(upload_id, 10)
+        response = self.send(upload_id, 20).json()
+
+        self.assertTrue(response['complete'])
+        message = ChatMessage.objects.get(id=response['message_id'])
+        with message.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertEqual((message.file_name, message.file_size, message.attachment.ref_count), ('notes.bin', 30, 1))
+
+    def test_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.start(sha256='0' * 64)
+        self.send(upload_id, 0, size=30)
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_removed_member_cannot_finish(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, size=20)
+        self.membership.delete()
+
+        self.assertEqual(self.send(upload_id, 20).status_code, 403)
+        self.assertFalse(ChatMessage.objects.exists())
+
+        # The last chunk was not kept, so the upload can still finish if access comes back
+        PrivateRoomMembership.objects.create(user=self.member, room=self.room)
+        self.assertEqual(self.status(upload_id)['offset'], 20)
+        self.assertTrue(self.send(upload_id, 20).json()['complete'])
+
+    def test_blocked_user_cannot_finish(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, size=20)
+        UserBlock.objects.create(user=self.member, blocked_by=self.owner, reason='spam', block_type='permanent')
+
+        # Refused by the view, or before it once the block ends the session
+        self.assertNotEqual(self.send(upload_id, 20).status_code, 200)
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertEqual(ChunkedUpload.objects.get().received, 20)
+
+
+class AttachmentTests(MediaRootMixin, TestCase):
+    """Identical uploads share one blob, which goes once no message uses it"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.user)
+        self.client.force_login(self.user)
+
+    def upload(self, data=b'same bytes', name='notes.txt'):
+        response = self.client.post(reverse('send_message', args=[self.room.slug]), {
+            'file': SimpleUploadedFile(name, data, content_type='text/plain'),
+        })
+        return ChatMessage.objects.get(id=response.json()['message_id'])
+
+    def test_same_bytes_are_stored_once(self):
+        first, second = self.upload(), self.upload(name='copy.txt')
+        self.upload(b'other bytes')
+
+        self.assertEqual(first.attachment_id, second.attachment_id)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.file_name, 'copy.txt')
+        self.assertEqual(Attachment.objects.get(pk=first.attachment_id).ref_count, 2)
+        self.assertEqual(Attachment.objects.count(), 2)
+
+    def test_blob_is_purged_with_the_last_message(self):
+        first, second = self.upload(), self.upload()
+        attachment, name = first.attachment, first.file.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.ref_count, 1)
+        self.assertTrue(attachment_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(attachment_storage.exists(name))
+
+    def test_room_delete_releases_every_message(self):
+        name = self.upload().file.name
+        self.upload()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.delete()
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(attachment_storage.exists(name))
+
+    def test_purge_keeps_a_blob_that_was_reused(self):
+        message = self.upload()
+        attachment_id, name = message.attachment_id, message.file.name
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            message.delete()
+            # Posted again before the purge runs
+            self.upload()
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(Attachment.objects.get(pk=attachment_id).ref_count, 1)
+        self.assertTrue(attachment_storage.exists(name))
+
+
+class RangeParsingTests(SimpleTestCase):
+    """A single byte range is honoured; anything else is refused or ignored"""
+
+    def test_parse_range(self):
+        cases = [
+            ('bytes=0-9', (0, 9)),
+            ('bytes=10-', (10, 99)),
+            ('bytes=-10', (90, 99)),
+            ('bytes=90-500', (90, 99)),
+            ('bytes=-500', (0, 99)),
+            ('bytes=100-', False),
+            ('bytes=-0', False),
+            ('bytes=9-0', None),
+            ('bytes=-', None),
+            ('bytes=0-1,5-6', None),
+            ('items=0-9', None),
+        ]
+        for header, expected in cases:
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 100), expected)
+
+
+class MediaServingTests(MediaRootMixin, TestCase):
+    """Files are served to room members, with Range, If-Range and conditional GET"""
+
+    data = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        self.outsider = User.objects.create_user('outsider')
+        self.room = ChatRoom.objects.create(name='Secret', slug='secret', owner=self.owner, room_type='private')
+        attachment = Attachment.store(SimpleUploadedFile('data.bin', self.data))
+        ChatMessage.objects.create(
+            user=self.owner, room=self.room, message_type='file', attachment=attachment,
+            file=attachment.file.name, file_name='data.bin', file_size=attachment.size,
+        )
+        self.url = reverse('serve_media', args=[attachment.file.name])
+        self.etag = f'"{attachment.sha256}"'
+        self.client.force_login(self.owner)
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+        self.assertEqual((response['ETag'], response['Accept-Ranges']), (self.etag, 'bytes'))
+
+    def test_range(self):
+        response = self.get(range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(self.body(response), self.data[100:200])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_if_range(self):
+        response = self.get(range='bytes=0-9', if_range=self.etag)
+        self.assertEqual((response.status_code, self.body(response)), (206, self.data[:10]))
+
+        # A stale validator gets the whole file instead of a piece of the wrong one
+        response = self.get(range='bytes=0-9', if_range='"stale"')
+        self.assertEqual((response.status_code, self.body(response)), (200, self.data))
+
+    def test_not_modified(self):
+        self.assertEqual(self.get(if_none_match=self.etag).status_code, 304)
+
+    def test_outsider_gets_not_found(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.get().status_code, 404)
+
+
+class AccessCodeTests(TestCase):
+    """Private rooms get unique access codes, which are looked up with a per-user limit"""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(missing_codes, '_codes', OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = User.objects.create_user('owner')
+        self.guest = User.objects.create_user('guest')
+        self.taken = ChatRoom.objects.create(name='First', slug='first', owner=self.owner, room_type='private')
+        self.client.force_login(self.guest)
+
+    def create(self, slug, codes):
+        with mock.patch.object(ChatRoom, 'generate_access_code', side_effect=codes):
+            return ChatRoom.objects.create(name=slug, slug=slug, owner=self.owner, room_type='private')
+
+    def join(self, code):
+        return self.client.post(reverse('join_private_room'), {'access_code': code})
+
+    def test_taken_code_is_drawn_again(self):
+        room = self.create('second', [self.taken.access_code, 'FRESH002'])
+        self.assertEqual(room.access_code, 'FRESH002')
+
+    def test_gives_up_after_the_attempts(self):
+        with self.assertRaises(IntegrityError):
+            self.create('second', [self.taken.access_code] * ACCESS_CODE_ATTEMPTS)
+        self.assertFalse(ChatRoom.objects.filter(slug='second').exists())
+
+    def test_other_integrity_errors_are_not_retried(self):
+        with self.assertRaises(IntegrityError):
+            self.create('first', ['FRESH002', 'FRESH003'])
+
+    def test_join_by_code(self):
+        response = self.join(self.taken.access_code.lower())
+        self.assertRedirects(response, reverse('chatroom', args=[self.taken.slug]), fetch_redirect_response=False)
+        self.assertTrue(PrivateRoomMembership.objects.filter(user=self.guest, room=self.taken).exists())
+
+    def test_code_guessed_before_the_room_existed(self):
+        self.assertEqual(self.join('LATER001').status_code, 200)
+        room = self.create('later', ['LATER001'])
+
+        self.join('LATER001')
+        self.assertTrue(PrivateRoomMembership.objects.filter(user=self.guest, room=room).exists())
+
+    @mock.patch('chatapp.access.JOIN_RATE_LIMIT', 2)
+    def test_lookups_are_rate_limited(self):
+        for code in ('WRONG001', 'WRONG002'):
+            self.assertEqual(self.join(code).status_code, 200)
+        self.assertEqual(self.join(self.taken.access_code).status_code, 429)
+        self.assertFalse(PrivateRoomMembership.objects.filter(user=self.guest).exists())
+
+
+class MessageSearchTests(TestCase):
+    """The FTS5 index follows the message table and results page by cursor"""
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice')
+        self.room = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+
+    def post(self, text):
+        return ChatMessage.objects.create(user=self.alice, room=self.room, message_content=text)
+
+    def found(self, query):
+        messages, _ = search_messages(ChatMessage.objects.all(), query, limit=100)
+        return [m.id for m in messages]
+
+    def test_backend_is_fts5(self):
+        self.assertIsInstance(get_search_backend(), SQLiteSearchBackend)
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        message = self.post('deploy finished')
+        [bulk] = ChatMessage.objects.bulk_create([
+            ChatMessage(user=self.alice, room=self.room, message_content='deployed again'),
+        ])
+        self.assertEqual(set(self.found('deploy')), {message.id, bulk.id})
+
+        ChatMessage.objects.filter(id=message.id).update(message_content='rollback')
+        self.assertEqual(self.found('deploy'), [bulk.id])
+        self.assertEqual(self.found('rollback'), [message.id])
+
+        message.delete()
+        self.assertEqual(self.found('rollback'), [])
+
+    def test_triggers_are_put_back(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {FTS_TABLE}_ai')
+        ensure_search_triggers()
+        message = self.post('hello there')
+        self.assertEqual(self.found('hello'), [message.id])
+
+    def test_every_word_must_match_as_a_prefix(self):
+        both = self.post('release notes are ready')
+        self.post('release is blocked')
+        self.assertEqual(self.found('rel note'), [both.id])
+
+    def test_pages_cover_every_match_once(self):
+        ids = [self.post(f'ping {i}').id for i in range(5)]
+        self.post('unrelated')
+        # Equal timestamps are ordered by id
+        ChatMessage.objects.filter(id__in=ids[1:3]).update(created_at=timezone.now())
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = search_messages(ChatMessage.objects.all(), 'ping', before=cursor, limit=2)
+            seen += [m.id for m in page]
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), ids)
+        self.assertEqual(len(seen), len(ids))
+
+    def test_highlight_is_escaped(self):
+        self.post('<b>alert</b> raised')
+        page, _ = search_messages(ChatMessage.objects.all(), 'alert')
+        self.assertIn('<mark>alert</mark>', page[0].search_highlight)
+        self.assertIn('&lt;b&gt;', page[0].search_highlight)
+
+    def test_empty_query_and_bad_cursor(self):
+        for query, before in (('   ', None), ('ping', 'not-a-cursor')):
+            with self.subTest(query=query, before=before), self.assertRaises(ValueError):
+                search_messages(ChatMessage.objects.all(), query, before=before)
+
+    def test_outsider_cannot_search_a_private_room(self):
+        private = ChatRoom.objects.create(name='Secret', slug='secret', owner=self.alice, room_type='private')
+        ChatMessage.objects.create(user=self.alice, room=private, message_content='hidden plans')
+        self.client.force_login(User.objects.create_user('outsider'))
+
+        response = self.client.get(reverse('search_room', args=[private.slug]), {'q': 'plans'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'plans'}).json()['results'], [])
+
+
+class RoomCounterTests(TestCase):
+    """Message counters on rooms follow deletes, cascades included"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.lobby = ChatRoom.objects.create(name='Lobby', slug='lobby', owner=self.alice)
+        self.other = ChatRoom.objects.create(name='Other', slug='other', owner=self.alice)
+        for room in (self.lobby, self.other):
+            for user in (self.alice, self.bob, self.bob):
+                ChatMessage.objects.create(user=user, room=room, message_content='hi')
+
+    def counts(self):
+        return dict(ChatRoom.objects.values_list('slug', 'message_count'))
+
+    def test_messages_are_counted(self):
+        self.assertEqual(self.counts(), {'lobby': 3, 'other': 3})
+
+    def test_deleting_a_message(self):
+        ChatMessage.objects.filter(room=self.lobby).first().delete()
+        self.assertEqual(self.counts(), {'lobby': 2, 'other': 3})
+
+    def test_deleting_a_user_uncounts_their_messages_in_each_room(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.delete()
+        self.assertEqual(self.counts(), {'lobby': 1, 'other': 1})
+
+    def test_deleting_a_room_leaves_the_others_alone(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lobby.delete()
+        self.assertEqual(self.counts(), {'other': 3})
+
+
+@mock.patch('chatapp.directory.DIRECTORY_PAGE_SIZE', 2)
+class DirectoryPageTests(TestCase):
+    """Directory pages are cached once per page actually built"""
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('owner')
+        for number in range(3):
+            ChatRoom.objects.create(name=f'Room {number}', slug=f'room-{number}', owner=self.owner)
+
+    def test_out_of_range_pages_share_the_last_page(self):
+        self.assertEqual(directory_page('99')['page'], 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(directory_page('50')['page'], 2)
+            self.assertEqual(directory_page('2')['page'], 2)
+
+    def test_bad_numbers_get_the_first_page(self):
+        for number in (None, 'x', '-3'):
+            with self.subTest(number=number):
+                self.assertEqual(directory_page(number)['page'], 1)
+
+    def test_new_room_drops_cached_pages(self):
+        self.assertEqual(directory_page(1)['count'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatRoom.objects.create(name='Room 3', slug='room-3', owner=self.owner)
+        self.assertEqual(directory_page(1)['count'], 4)
+
+
+@override_settings(SESSION_SAVE_EVERY_REQUEST=False, SESSION_REFRESH_INTERVAL=3600)
+class SessionRefreshTests(TestCase):
+    """Unchanged sessions are saved once per refresh interval, not on every request"""
+
+    key = SessionRefreshMiddleware.REFRESHED_KEY
+
+    def request(self, session, view=lambda request: request.session.get('user'), now=10000):
+        request = RequestFactory().get('/')
+        request.session = session
+        middleware = SessionRefreshMiddleware(lambda request: view(request) or HttpResponse())
+        with mock.patch('chatapp.middleware.time.time', return_value=now):
+            middleware(request)
+        return session
+
+    def stored(self, refreshed_at):
+        session = SessionStore()
+        session.update({'user': 'alice', self.key: refreshed_at})
+        session.save()
+        return SessionStore(session.session_key)
+
+    def test_recent_session_is_not_saved(self):
+        session = self.request(self.stored(refreshed_at=9000))
+        self.assertFalse(session.modified)
+
+    def test_due_session_is_refreshed(self):
+        session = self.request(self.stored(refreshed_at=6400))
+        self.assertTrue(session.modified)
+        self.assertEqual(session[self.key], 10000)
+
+    def test_changed_session_records_the_save(self):
+        def view(request):
+            request.session['theme'] = 'dark'
+        session = self.request(self.stored(refreshed_at=9000), view)
+        self.assertEqual(session[self.key], 10000)
+
+    def test_unread_and_empty_sessions_are_left_alone(self):
+        unread = self.request(self.stored(refreshed_at=0), view=lambda request: None)
+        self.assertFalse(unread.accessed or unread.modified)
+
+        empty = self.request(SessionStore())
+        self.assertFalse(empty.modified)
+        self.assertIsNone(empty.session_key)
+
+    @override_settings(SESSION_SAVE_EVERY_REQUEST=True)
+    def test_off_when_every_request_saves(self):
+        session = self.request(self.stored(refreshed_at=0))
+        self.assertNotEqual(session[self.key], 10000)
@@ -0,0 +1,142 @@
+"""
+Background WebP thumbnails for image messages.
+
+Rooms used to show every image at full resolution and shrink it with CSS,
+so opening a busy room downloaded megabytes of originals. When an image
+message is committed, a small thread pool decodes it with Pillow and writes
+a WebP at each of ``CHAT_THUMBNAIL_SIZES`` (longest edge, in pixels) in a
+``thumbs/`` directory next to the original. Messages sharing an attachment
+share its thumbnails. The storage names are saved
+on ``ChatMessage.thumbnails`` and served by ``get_messages`` and the socket
+as ``thumbnails``; the original stays available for download.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = tuple(getattr(settings, 'CHAT_THUMBNAIL_SIZES', (320, 640, 1280)))
+THUMBNAIL_WORKERS = getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2)
+THUMBNAIL_QUALITY = getattr(settings, 'CHAT_THUMBNAIL_QUALITY', 80)
+
+
+def thumbnail_name(file_name, size):
+    """Storage name of the WebP thumbnail of file_name at one size"""
+    directory, base = os.path.split(file_name)
+    stem = os.path.splitext(base)[0]
+    return os.path.join(directory, 'thumbs', f'{stem}_{size}.webp')
+
+
+def render_thumbnails(message):
+    """Write the thumbnails of an image message and return {size: storage name}"""
+    storage = default_storage
+    thumbnails = {}
+
+    with message.file.open('rb') as source, Image.open(source) as image:
+        # Let the JPEG decoder skip detail the thumbnails will not use
+        image.draft('RGB', (max(THUMBNAIL_SIZES),) * 2)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        # Sizes above the original would only be identical copies; keep just the first of them
+        original = max(image.size)
+        sizes = [size for size in THUMBNAIL_SIZES if size < original]
+        sizes += sorted(size for size in THUMBNAIL_SIZES if size >= original)[:1]
+
+        # Largest first, so each smaller size is scaled from the previous one
+        for size in sorted(sizes, reverse=True):
+            if max(image.size) > size:
+                image = image.copy()
+                image.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, 'WEBP', quality=THUMBNAIL_QUALITY, method=4)
+            name = thumbnail_name(message.file.name, size)
+            if storage.exists(name):
+                storage.delete(name)
+            thumbnails[str(size)] = storage.save(name, ContentFile(buffer.getvalue()))
+
+    return thumbnails
+
+
+def delete_thumbnails(file_name):
+    """Remove every thumbnail rendered from a file"""
+    directory = os.path.dirname(thumbnail_name(file_name, 0))
+    prefix = os.path.splitext(os.path.basename(file_name))[0] + '_'
+    try:
+        _, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in files:
+        if name.startswith(prefix) and name.endswith('.webp'):
+            default_storage.delete(os.path.join(directory, name))
+
+
+class ThumbnailPool:
+    """Thread pool that renders thumbnails off the request path"""
+
+    def __init__(self, workers=THUMBNAIL_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        # One render at a time per file, so messages sharing an attachment reuse the first result
+        self._file_locks = {}
+
+    def schedule(self, message_id):
+        """Queue a message's thumbnails once the current transaction commits"""
+        transaction.on_commit(lambda: self.submit(message_id))
+
+    def submit(self, message_id, reuse=True):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='chat-thumbnails')
+            return self._executor.submit(self._generate, message_id, reuse)
+
+    def _generate(self, message_id, reuse=True):
+        try:
+            message = ChatMessage.objects.select_related('room').filter(id=message_id, message_type='image').first()
+            if message is None or not message.file:
+                return None
+            with self._lock:
+                file_lock = self._file_locks.setdefault(message.file.name, threading.Lock())
+            with file_lock:
+                shared = None
+                if reuse and message.attachment_id:
+                    shared = ChatMessage.objects.filter(attachment_id=message.attachment_id).exclude(
+                        thumbnails={}).values_list('thumbnails', flat=True).first()
+                thumbnails = shared or render_thumbnails(message)
+                # Write just this column so a concurrent save of the message is not undone
+                ChatMessage.objects.filter(id=message_id).update(thumbnails=thumbnails)
+            with self._lock:
+                if not file_lock.locked():
+                    self._file_locks.pop(message.file.name, None)
+            return thumbnails
+        except (OSError, Image.DecompressionBombError):
+            logger.warning('Could not create thumbnails for message %s', message_id, exc_info=True)
+        except Exception:
+            logger.exception('Thumbnail generation failed for message %s', message_id)
+        finally:
+            close_old_connections()
+        return None
+
+    def close(self, wait=True):
+        """Finish queued thumbnails and stop the workers"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+thumbnail_pool = ThumbnailPool()
@@ -0,0 +1,256 @@
+"""
+Resumable, chunked file uploads for chat messages.
+
+Instead of posting a whole file to ``send_message``, the client starts an
+upload, then sends the raw bytes in chunks of at most ``CHAT_UPLOAD_CHUNK_SIZE``
+with the offset they start at. Each chunk is streamed to its own file
+first, then, with the upload row locked, appended to
+``MEDIA_ROOT/chat_files/<slug>/.uploads/<id>.part`` and fed to a SHA-256
+hash, so no request holds more than one small buffer in memory or keeps
+the row locked while a slow client sends. After an interruption the client asks for the current offset and
+carries on from there. The ``ChatMessage`` is created only once the last
+chunk is in.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET, require_POST
+
+from .access import can_access_room
+from .models import Attachment, ChatMessage, ChatRoom, ChunkedUpload, UserBlock
+from .realtime import broadcast_message
+from .storage import attachment_storage
+
+CHUNK_SIZE = getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024)  # bytes
+MAX_UPLOAD_SIZE = getattr(settings, 'CHAT_UPLOAD_MAX_SIZE', 100 * 1024 * 1024)  # bytes
+READ_SIZE = 64 * 1024
+
+# upload id -> (offset, running sha256) for uploads in progress in this process.
+# If a chunk lands on another worker, or after a restart, the hash is rebuilt
+# from the part file.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+def _hasher_at(upload, offset):
+    """Running SHA-256 of the first ``offset`` bytes of an upload"""
+    with _hashers_lock:
+        cached = _hashers.pop(upload.id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    if offset:
+        with open(upload.part_path, 'rb') as part:
+            remaining = offset
+            while remaining:
+                data = part.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def _refuse_sender(user, room):
+    """The response refusing a user who may not post files to a room, or None"""
+    if not can_access_room(user, room):
+        return JsonResponse({'success': False, 'error': 'You do not have access to this room.'}, status=403)
+    if UserBlock.is_user_blocked(user):
+        return JsonResponse({'success': False, 'error': 'You are currently blocked from sending messages.'})
+    return None
+
+
+def _upload_status(upload):
+    data = {
+        'success': True,
+        'upload_id': str(upload.id),
+        'offset': upload.received,
+        'total_size': upload.total_size,
+        'chunk_size': CHUNK_SIZE,
+        'complete': upload.is_complete,
+    }
+    if upload.is_complete:
+        data['message_id'] = upload.message_id
+    return data
+
+
+def _finish_upload(upload, hasher):
+    """Move the completed file into the attachment store and post it as a message"""
+    upload.sha256 = hasher.hexdigest()
+    if upload.expected_sha256 and upload.expected_sha256 != upload.sha256:
+        raise ValueError('Checksum mismatch')
+
+    # The hash is already known, so the part file moves into the blob store without a second read
+    attachment = Attachment.store_path(upload.part_path, upload.sha256, upload.file_name, upload.content_type)
+
+    chat_message = ChatMessage.objects.create(
+        user=upload.user,
+        room=upload.room,
+        message_content=upload.caption,
+        message_type='image' if attachment.is_image else 'file',
+        attachment=attachment,
+        file=attachment.file.name,
+        file_name=upload.file_name,
+        file_size=attachment.size
+    )
+    upload.message = chat_message
+    upload.save(update_fields=['sha256', 'message', 'updated_at'])
+    broadcast_message(chat_message)
+    return chat_message
+
+
+@login_required
+@require_POST
+def start_upload(request, slug):
+    """Start a chunked upload and return its id"""
+    room = get_object_or_404(ChatRoom, slug=slug)
+    refused = _refuse_sender(request.user, room)
+    if refused is not None:
+        return refused
+
+    file_name = os.path.basename(request.POST.get('file_name', '').strip())
+    try:
+        total_size = int(request.POST.get('file_size', ''))
+    except ValueError:
+        total_size = -1
+    if not file_name or total_size <= 0:
+        return JsonResponse({'success': False, 'error': 'A file name and size are required'}, status=400)
+    if total_size > MAX_UPLOAD_SIZE:
+        return JsonResponse({
+            'success': False,
+            'error': f'Files can be at most {MAX_UPLOAD_SIZE // (1024 * 1024)} MB'
+        }, status=413)
+
+    upload = ChunkedUpload.objects.create(
+        user=request.user,
+        room=room,
+        file_name=file_name[:255],
+        content_type=request.POST.get('content_type', '')[:100],
+        total_size=total_size,
+        caption=request.POST.get('message', '').strip(),
+        expected_sha256=request.POST.get('sha256', '').lower()[:64],
+    )
+    os.makedirs(os.path.dirname(upload.part_path), exist_ok=True)
+    return JsonResponse(_upload_status(upload), status=201)
+
+
+@login_required
+@require_GET
+def upload_status(request, slug, upload_id):
+    """Report how much of an upload has arrived, so the client can resume"""
+    upload = get_object_or_404(ChunkedUpload.objects.select_related('room'), id=upload_id, room__slug=slug, user=request.user)
+    return JsonResponse(_upload_status(upload))
+
+
+def _check_chunk(upload, offset, length):
+    """The response refusing a chunk at ``offset``, or None if it can be appended"""
+    if upload.is_complete:
+        return JsonResponse(_upload_status(upload))
+    if offset != upload.received:
+        # Out of order or a retry of an earlier chunk: tell the client where to resume
+        return JsonResponse({**_upload_status(upload), 'success': False, 'error': 'Offset mismatch'}, status=409)
+    if offset + length > upload.total_size:
+        return JsonResponse({'success': False, 'error': 'Chunk runs past the declared file size'}, status=400)
+    return None
+
+
+def _receive_chunk(request, path, length):
+    """Stream up to ``length`` bytes of the request body into ``path``; returns how many arrived"""
+    written = 0
+    with open(path, 'wb') as chunk:
+        while written < length:
+            data = request.read(min(READ_SIZE, length - written))
+            if not data:
+                break
+            chunk.write(data)
+            written += len(data)
+    return written
+
+
+def _restore_part(upload):
+    """Put the part file back after a failed finish moved it into the blob store"""
+    if os.path.exists(upload.part_path) or not upload.sha256:
+        return
+    blob = attachment_storage.path(attachment_storage.blob_name(upload.sha256, os.path.splitext(upload.file_name)[1]))
+    try:
+        os.link(blob, upload.part_path)
+    except OSError:
+        shutil.copyfile(blob, upload.part_path)
+
+
+@login_required
+@require_POST
+def upload_chunk(request, slug, upload_id):
+    """Append one chunk, sent as the raw request body at the Upload-Offset header"""
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Upload-Offset header is required'}, status=400)
+    if length <= 0 or length > CHUNK_SIZE:
+        return JsonResponse({'success': False, 'error': f'Chunks must be 1 to {CHUNK_SIZE} bytes'}, status=400)
+
+    uploads = ChunkedUpload.objects.select_related('room', 'user')
+    upload = get_object_or_404(uploads, id=upload_id, room__slug=slug, user=request.user)
+    # Access or a block may have changed since the upload started
+    refused = _refuse_sender(request.user, upload.room)
+    if refused is None:
+        refused = _check_chunk(upload, offset, length)
+    if refused is not None:
+        return refused
+
+    # Read the body before locking the upload, so a slow client holds no lock
+    chunk_path = f'{upload.part_path}.{uuid.uuid4().hex}.chunk'
+    try:
+        written = _receive_chunk(request, chunk_path, length)
+
+        with transaction.atomic():
+            upload = get_object_or_404(uploads.select_for_update(), id=upload_id, room__slug=slug, user=request.user)
+            # Another request may have appended this offset while the body was arriving
+            refused = _check_chunk(upload, offset, written)
+            if refused is None and offset + written == upload.total_size:
+                # Checked again before posting, without keeping the last chunk if refused
+                refused = _refuse_sender(request.user, upload.room)
+            if refused is not None:
+                return refused
+
+            hasher = _hasher_at(upload, offset)
+            with open(upload.part_path, 'r+b' if offset else 'wb') as part, open(chunk_path, 'rb') as chunk:
+                part.seek(offset)
+                part.truncate()
+                for data in iter(lambda: chunk.read(READ_SIZE), b''):
+                    part.write(data)
+                    hasher.update(data)
+
+            upload.received = offset + written
+            upload.save(update_fields=['received', 'updated_at'])
+
+            if upload.received == upload.total_size:
+                try:
+                    with transaction.atomic():
+                        _finish_upload(upload, hasher)
+                except ValueError as e:
+                    os.remove(upload.part_path)
+                    upload.delete()
+                    return JsonResponse({'success': False, 'error': str(e)}, status=400)
+                except Exception:
+                    # received is rolled back too, so a retry of the last chunk finds the part file again
+                    _restore_part(upload)
+                    raise
+            else:
+                with _hashers_lock:
+                    _hashers[upload.id] = (upload.received, hasher)
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+    return JsonResponse(_upload_status(upload))
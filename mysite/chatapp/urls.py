@@ -4,9 +4,12 @@ from . import views
 from .admin_setup import setup_admin
 from .debug_views import debug_auth_status
 from . import admin_views
+from . import upload_views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('directory.json', views.room_directory, name='room_directory'),
+    path('search.json', views.search, name='search'),
     path('login/', views.login_view, name='login'),
     path('register/', views.register_view, name='register'),
     path('logout/', views.logout_view, name='logout'),
@@ -26,7 +29,12 @@ urlpatterns = [
     
     path('<slug:slug>/', views.chatroom, name='chatroom'),
     path('<slug:slug>/send/', views.send_message, name='send_message'),
+    path('<slug:slug>/uploads/', upload_views.start_upload, name='start_upload'),
+    path('<slug:slug>/uploads/<uuid:upload_id>/', upload_views.upload_status, name='upload_status'),
+    path('<slug:slug>/uploads/<uuid:upload_id>/chunk/', upload_views.upload_chunk, name='upload_chunk'),
     path('<slug:slug>/messages/', views.get_messages, name='get_messages'),
+    path('<slug:slug>/history/', views.message_history, name='message_history'),
+    path('<slug:slug>/search/', views.search_room, name='search_room'),
     path('<slug:slug>/presence/', views.update_presence, name='update_presence'),
     path('<slug:slug>/leave/', views.leave_room, name='leave_room'),
     path('<slug:slug>/message/<int:message_id>/react/', views.toggle_reaction, name='toggle_reaction'),
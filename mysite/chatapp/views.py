@@ -3,56 +3,54 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.db import transaction
+from django.utils import timezone
 from django.utils.text import slugify
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from .models import ChatRoom, ChatMessage, UserPresence, MessageReaction, PrivateRoomMembership, UserBlock
+from django.views.decorators.cache import cache_control
+from django.views.decorators.vary import vary_on_cookie
+from .access import accessible_rooms_filter, can_access_room, join_rate_limited, room_for_access_code, room_for_slug
+from .directory import directory_page
+from .models import Attachment, ChatRoom, ChatMessage, UserPresence, MessageReaction, PrivateRoomMembership, UserBlock
 from .forms import CustomRegistrationForm
+from .pagination import MAX_PAGE_SIZE, history_page, delta_page, clamp_page_size
+from .realtime import broadcast_message, reaction_broadcaster
+from .presence import HEARTBEAT_BUFFERED, presence_heartbeats
+from .search import search_messages
+from .middleware import poll_etag
 
 # Create your views here.
 def index(request):
-    # Only show public rooms on the main page
-    chatrooms = ChatRoom.objects.filter(room_type='public').order_by('-created_at')
-    return render(request, 'chatapp/index.html', {'chatrooms': chatrooms})
+    # Only show public rooms on the main page, a cached page at a time
+    directory = directory_page(request.GET.get('page'))
+    return render(request, 'chatapp/index.html', {'directory': directory, 'chatrooms': directory['rooms']})
+
+def room_directory(request):
+    """The public room directory as JSON, one cached page at a time"""
+    return JsonResponse(directory_page(request.GET.get('page')))
 
 @login_required
 def chatroom(request, slug):
     chatroom = get_object_or_404(ChatRoom, slug=slug)
     
-    # Check if user has access to private room
-    if chatroom.room_type == 'private':
-        # Room owner always has access
-        if chatroom.owner != request.user:
-            # Check if user is a member of the private room
-            if not PrivateRoomMembership.objects.filter(user=request.user, room=chatroom).exists():
-                messages.error(request, 'You do not have access to this private room.')
-                return redirect('private_rooms')
+    # Private rooms are checked against the user's cached set of accessible rooms
+    if not can_access_room(request.user, chatroom):
+        messages.error(request, 'You do not have access to this private room.')
+        return redirect('private_rooms')
     
     # Update user presence when entering room
     UserPresence.update_user_presence(request.user, chatroom)
     
     # Get the last 30 messages for initial display
-    all_messages = ChatMessage.objects.filter(room=chatroom).order_by('date').prefetch_related('reactions__user')
-    chat_messages = all_messages[max(0, all_messages.count() - 30):]
+    all_messages = ChatMessage.objects.filter(room=chatroom).select_related('user')
+    chat_messages, history_cursor = history_page(all_messages)
     
-    # Prepare reaction data for each message
+    # Reaction counts for the whole page come from one aggregated query
+    reactions = MessageReaction.summarize([message.id for message in chat_messages], request.user)
     for message in chat_messages:
-        reaction_counts = {}
-        for reaction in message.reactions.all():
-            emoji_key = reaction.emoji
-            if emoji_key not in reaction_counts:
-                reaction_counts[emoji_key] = {
-                    'count': 0,
-                    'users': [],
-                    'user_reacted': False
-                }
-            reaction_counts[emoji_key]['count'] += 1
-            reaction_counts[emoji_key]['users'].append(reaction.user.username)
-            if reaction.user == request.user:
-                reaction_counts[emoji_key]['user_reacted'] = True
-        
-        message.reaction_data = reaction_counts
+        message.reaction_data = reactions.get(message.id, {})
     
     # Get online users
     online_users = UserPresence.get_online_users(chatroom)
@@ -60,15 +58,86 @@ def chatroom(request, slug):
     return render(request, 'chatapp/room.html', {
         'chatroom': chatroom, 
         'chat_messages': chat_messages,
+        'last_message_id': chat_messages[-1].id if chat_messages else 0,
+        'history_cursor': history_cursor,
         'online_users': online_users
     })
 
+@login_required
+def message_history(request, slug):
+    """Get a page of older messages before a cursor"""
+    room = get_object_or_404(ChatRoom, slug=slug)
+    
+    if not can_access_room(request.user, room):
+        return JsonResponse({'error': 'You do not have access to this room.'}, status=403)
+    
+    limit = clamp_page_size(request.GET.get('limit'))
+    queryset = ChatMessage.objects.filter(room=room).select_related('user')
+    try:
+        page, next_cursor = history_page(queryset, before=request.GET.get('before'), limit=limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    reactions = MessageReaction.summarize([msg.id for msg in page], request.user)
+    return JsonResponse({
+        'messages': [msg.to_dict(reactions.get(msg.id)) for msg in page],
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    })
+
+def search_results(request, queryset):
+    """JSON page of search results for ?q= within queryset"""
+    limit = clamp_page_size(request.GET.get('limit'))
+    try:
+        page, next_cursor = search_messages(
+            queryset, request.GET.get('q', ''), before=request.GET.get('before'), limit=limit
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    results = []
+    for msg in page:
+        data = msg.to_dict()
+        data.update({
+            'highlight': msg.search_highlight,
+            'room': {'name': msg.room.name, 'slug': msg.room.slug},
+        })
+        results.append(data)
+    return JsonResponse({
+        'results': results,
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    })
+
+@login_required
+def search_room(request, slug):
+    """Search the messages of one room"""
+    room = get_object_or_404(ChatRoom, slug=slug)
+    
+    if not can_access_room(request.user, room):
+        return JsonResponse({'error': 'You do not have access to this room.'}, status=403)
+    
+    return search_results(request, ChatMessage.objects.filter(room=room).select_related('user', 'room'))
+
+@login_required
+def search(request):
+    """Search the messages of every room the user can access"""
+    queryset = ChatMessage.objects.filter(
+        accessible_rooms_filter(request.user, prefix='room__')
+    ).select_related('user', 'room')
+    return search_results(request, queryset)
+
 @login_required
 def update_presence(request, slug):
     """Update user presence via AJAX"""
     try:
         chatroom = ChatRoom.objects.get(slug=slug)
-        UserPresence.update_user_presence(request.user, chatroom)
+        if not can_access_room(request.user, chatroom):
+            return JsonResponse({'success': False, 'error': 'You do not have access to this room.'}, status=403)
+        if HEARTBEAT_BUFFERED:
+            presence_heartbeats.record(request.user, chatroom)
+        else:
+            UserPresence.update_user_presence(request.user, chatroom)
         
         # Get updated online users list
         online_users = UserPresence.get_online_users(chatroom)
@@ -80,6 +149,14 @@ def update_presence(request, slug):
                 'is_current_user': presence.user == request.user
             })
         
+        # A buffered heartbeat may not be written yet; the caller is online regardless
+        if not any(user['is_current_user'] for user in users_data):
+            users_data.append({
+                'username': request.user.username,
+                'last_seen': timezone.now().strftime('%H:%M'),
+                'is_current_user': True
+            })
+        
         return JsonResponse({'success': True, 'online_users': users_data})
     except ChatRoom.DoesNotExist:
         return JsonResponse({'success': False, 'error': 'Room not found'})
@@ -89,7 +166,12 @@ def leave_room(request, slug):
     """Set user offline when leaving room"""
     try:
         chatroom = ChatRoom.objects.get(slug=slug)
-        UserPresence.set_user_offline(request.user, chatroom)
+        if not can_access_room(request.user, chatroom):
+            return JsonResponse({'success': False, 'error': 'You do not have access to this room.'}, status=403)
+        if HEARTBEAT_BUFFERED:
+            presence_heartbeats.record(request.user, chatroom, online=False)
+        else:
+            UserPresence.set_user_offline(request.user, chatroom)
         return JsonResponse({'success': True})
     except ChatRoom.DoesNotExist:
         return JsonResponse({'success': False})
@@ -99,6 +181,9 @@ def send_message(request, slug):
     """Send a message to a chat room"""
     if request.method == 'POST':
         room = get_object_or_404(ChatRoom, slug=slug)
+        if not can_access_room(request.user, room):
+            return JsonResponse({'success': False, 'error': 'You do not have access to this room.'}, status=403)
+        
         message = request.POST.get('message', '').strip()
         uploaded_file = request.FILES.get('file')
         
@@ -114,28 +199,35 @@ def send_message(request, slug):
             # Determine message type
             message_type = 'text'
             file_name = ''
-            file_size = 0
+            attachment = None
             
-            if uploaded_file:
-                file_name = uploaded_file.name
-                file_size = uploaded_file.size
-                
-                # Check if it's an image
-                if uploaded_file.content_type and uploaded_file.content_type.startswith('image/'):
-                    message_type = 'image'
-                else:
-                    message_type = 'file'
+            # One transaction, so the attachment row stays locked until the message references it
+            with transaction.atomic():
+                if uploaded_file:
+                    file_name = uploaded_file.name
+                    # Stored once per distinct content, however many messages post it
+                    attachment = Attachment.store(uploaded_file, uploaded_file.content_type)
+                    
+                    # Check if it's an image
+                    if attachment.is_image:
+                        message_type = 'image'
+                    else:
+                        message_type = 'file'
+                    
+                # Create the message
+                chat_message = ChatMessage.objects.create(
+                    user=request.user,
+                    room=room,
+                    message_content=message,
+                    message_type=message_type,
+                    attachment=attachment,
+                    file=attachment.file.name if attachment else None,
+                    file_name=file_name,
+                    file_size=attachment.size if attachment else 0
+                )
             
-            # Create the message
-            chat_message = ChatMessage.objects.create(
-                user=request.user,
-                room=room,
-                message_content=message,
-                message_type=message_type,
-                file=uploaded_file,
-                file_name=file_name,
-                file_size=file_size
-            )
+            # Deliver to open WebSockets; polling clients still pick it up
+            broadcast_message(chat_message)
             
             return JsonResponse({
                 'success': True, 
@@ -149,42 +241,50 @@ def send_message(request, slug):
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
 @login_required
+@vary_on_cookie
+@cache_control(private=True, no_cache=True)
 def get_messages(request, slug):
-    """Get messages for a chat room"""
+    """Get messages newer than last_message_id, at most one batch at a time"""
     try:
-        room = get_object_or_404(ChatRoom, slug=slug)
-        last_message_id = request.GET.get('last_message_id', 0)
+        last_message_id = int(request.GET.get('last_message_id') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid last_message_id', 'messages': []}, status=400)
+    
+    # Access is checked first, so nothing about a room's activity reaches non-members;
+    # the room and the user's private rooms both come from the cache
+    room = room_for_slug(slug)
+    if room is None:
+        return JsonResponse({'error': 'Room not found', 'messages': []}, status=404)
+    if not can_access_room(request.user, room):
+        return JsonResponse({'error': 'You do not have access to this room.', 'messages': []}, status=403)
+    
+    # Idle rooms are answered from the cache without touching the database
+    high_water = ChatMessage.high_water_mark(slug)
+    if high_water is not None and high_water <= last_message_id:
+        response = JsonResponse({'messages': [], 'has_more': False, 'last_message_id': last_message_id})
+        # Repeating this poll gets a 304 from PollNotModifiedMiddleware
+        response['ETag'] = poll_etag(request, slug, high_water)
+        return response
+    
+    try:
+        limit = clamp_page_size(request.GET.get('limit'), default=MAX_PAGE_SIZE)
+        rows, has_more = delta_page(ChatMessage.objects.filter(room=room), last_message_id, limit)
         
-        # Get messages newer than the last received message
-        messages = ChatMessage.objects.filter(
-            room=room, 
-            id__gt=last_message_id
-        ).order_by('date')
+        if high_water is None and not has_more:
+            ChatMessage.refresh_high_water_mark(room)
         
-        messages_data = []
-        for msg in messages:
-            message_data = {
-                'id': msg.id,
-                'username': msg.user.username,
-                'message': msg.message_content,  # Fixed: use message_content field
-                'message_content': msg.message_content,
-                'message_type': msg.message_type,
-                'time': msg.date.strftime('%H:%M'),
-                'date': msg.date.isoformat(),
-                'reactions': {}  # Add reactions support later if needed
-            }
-            
-            # Add file information if it's a file/image message
-            if msg.file:
-                message_data.update({
-                    'file_url': msg.file.url,
-                    'file_name': msg.file_name,
-                    'file_size': msg.get_file_size_display() if hasattr(msg, 'get_file_size_display') else getattr(msg, 'file_size', 0)
-                })
-            
-            messages_data.append(message_data)
+        reactions = MessageReaction.summarize([row['id'] for row in rows], request.user)
+        messages_data = [ChatMessage.dict_from_values(row, reactions.get(row['id'])) for row in rows]
         
-        return JsonResponse({'messages': messages_data})
+        response = JsonResponse({
+            'messages': messages_data,
+            'has_more': has_more,
+            'last_message_id': rows[-1]['id'] if rows else last_message_id
+        })
+        # Only valid while the mark read before the query is still current
+        if high_water is not None:
+            response['ETag'] = poll_etag(request, slug, high_water)
+        return response
     
     except Exception as e:
         return JsonResponse({
@@ -197,21 +297,24 @@ def toggle_reaction(request, slug, message_id):
     """Toggle reaction on a message"""
     if request.method == 'POST':
         room = get_object_or_404(ChatRoom, slug=slug)
+        if not can_access_room(request.user, room):
+            return JsonResponse({'status': 'error', 'error': 'You do not have access to this room.'}, status=403)
         message = get_object_or_404(ChatMessage, id=message_id, room=room)
         emoji = request.POST.get('emoji')
+        if emoji not in MessageReaction.EMOJI_VALUES:
+            return JsonResponse({'status': 'error', 'error': 'Unsupported reaction.'}, status=400)
         
-        if emoji:
-            reaction, created = MessageReaction.objects.get_or_create(
-                user=request.user,
-                message=message,
-                emoji=emoji
-            )
-            
-            if not created:
-                reaction.delete()
-                return JsonResponse({'status': 'removed'})
-            
-            return JsonResponse({'status': 'added'})
+        reaction = MessageReaction.toggle_reaction(message, request.user, emoji)
+        reaction_counts = MessageReaction.summarize([message.id], request.user).get(message.id, {})
+        
+        # Other clients get the new count in the next coalesced update
+        reaction_broadcaster.record(room.slug, message.id, emoji)
+        
+        return JsonResponse({
+            'success': True,
+            'status': 'added' if reaction else 'removed',
+            'reaction_counts': reaction_counts
+        })
     
     return JsonResponse({'status': 'error'})
 
@@ -240,11 +343,17 @@ def join_private_room(request):
             messages.error(request, 'Please enter an access code')
             return render(request, 'chatapp/join_private_room.html')
         
-        try:
-            room = ChatRoom.objects.get(access_code=access_code, room_type='private')
-            
-            # Check if user is already a member
-            if PrivateRoomMembership.objects.filter(user=request.user, room=room).exists():
+        # Limit guesses per user so access codes cannot be brute-forced
+        if join_rate_limited(request.user):
+            messages.error(request, 'Too many attempts. Please wait a minute and try again.')
+            return render(request, 'chatapp/join_private_room.html', status=429)
+        
+        room = room_for_access_code(access_code)
+        if room is None:
+            messages.error(request, 'Invalid access code. Please check and try again.')
+        else:
+            # Check if user is already a member (or the owner)
+            if can_access_room(request.user, room):
                 messages.info(request, 'You are already a member of this room')
                 return redirect('chatroom', slug=room.slug)
             
@@ -252,9 +361,6 @@ def join_private_room(request):
             PrivateRoomMembership.objects.create(user=request.user, room=room)
             messages.success(request, f'Successfully joined "{room.name}"!')
             return redirect('chatroom', slug=room.slug)
-            
-        except ChatRoom.DoesNotExist:
-            messages.error(request, 'Invalid access code. Please check and try again.')
     
     return render(request, 'chatapp/join_private_room.html')
 
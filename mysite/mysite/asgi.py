@@ -7,7 +7,9 @@ For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
+import sys
 import django
 from django.core.asgi import get_asgi_application
 
@@ -18,12 +20,52 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 django_asgi_app = get_asgi_application()
 
 # Import Django apps after Django is set up
+from asgiref.sync import sync_to_async
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.urls import re_path
 import chatapp.routing
+from chatapp.persistence import message_buffer
+from chatapp.presence import presence_registry
+from chatapp.thumbnails import thumbnail_pool
+
+
+async def shutdown():
+    """Flush buffered chat messages, presence and thumbnails before the server exits"""
+    await message_buffer.close()
+    await presence_registry.close()
+    await sync_to_async(thumbnail_pool.close, thread_sensitive=False)()
+
+
+async def lifespan_app(scope, receive, send):
+    """Run shutdown() on servers that send ASGI lifespan events (uvicorn, hypercorn)"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# daphne sends no lifespan events. It runs on Twisted's asyncio reactor
+# (installed before the application is imported) and, on SIGTERM or SIGINT,
+# waits for the reactor's "before shutdown" triggers to finish.
+if 'twisted.internet.reactor' in sys.modules:
+    from twisted.internet import defer, reactor
+
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(shutdown()))
+    )
+
 
 application = ProtocolTypeRouter({
-    'http': django_asgi_app,
+    # Long-polling is handled asynchronously by Channels; everything else by Django
+    'http': URLRouter(chatapp.routing.http_urlpatterns + [
+        re_path(r'', django_asgi_app),
+    ]),
+    'lifespan': lifespan_app,
     'websocket': AuthMiddlewareStack(
         URLRouter(
             chatapp.routing.websocket_urlpatterns
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 from pathlib import Path
 import os
 from decouple import config, Csv
+from django.core.exceptions import ImproperlyConfigured
 import dj_database_url
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,7 +56,11 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    # Before sessions, so unchanged polls are answered without any queries
+    'chatapp.middleware.PollNotModifiedMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    # After sessions, so its response phase runs before the session is saved
+    'chatapp.middleware.SessionRefreshMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -85,18 +90,62 @@ TEMPLATES = [
 WSGI_APPLICATION = 'mysite.wsgi.application'
 ASGI_APPLICATION = 'mysite.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Channel layer used to fan chat events out to WebSocket workers:
+#   memory        - in-process layer; single worker, local development and tests
+#   redis         - channels_redis on REDIS_URL; any number of workers
+#   sharded-redis - groups spread over CHANNEL_REDIS_URLS with a hash ring
+CHANNEL_LAYER = config('CHANNEL_LAYER', default='memory')
+REDIS_URL = config('REDIS_URL', default='redis://localhost:6379/0')
+CHANNEL_REDIS_URLS = config('CHANNEL_REDIS_URLS', default=REDIS_URL, cast=Csv())
+
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
+    }
+elif CHANNEL_LAYER == 'sharded-redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chatapp.channel_layers.ShardedRedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_REDIS_URLS,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
-    # For production, use Redis:
-    # 'default': {
-    #     'BACKEND': 'channels_redis.core.RedisChannelLayer',
-    #     'CONFIG': {
-    #         "hosts": [config('REDIS_URL', default='redis://localhost:6379/0')],
-    #     },
-    # }
-}
+
+# Cache for hot lookups such as block status:
+#   locmem - per-process memory; single worker, local development and tests
+#   redis  - shared Redis on CACHE_REDIS_URL so every worker sees invalidations
+CACHE = config('CACHE', default='locmem')
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default=REDIS_URL)
+
+if CACHE == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Answer idle message polls from a cached "newest message per room" (and with
+# 304s) without touching the database. Only safe when every worker shares the cache.
+CHAT_HIGH_WATER_CACHE = CACHE == 'redis'
 
 
 # Database
@@ -158,6 +207,13 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Who sends media once Django has checked room access:
+#   (empty)  - Django streams the file itself
+#   nginx    - X-Accel-Redirect to MEDIA_ACCEL_PREFIX, an internal location aliased to MEDIA_ROOT
+#   sendfile - X-Sendfile with the file's path (Apache mod_xsendfile, lighttpd)
+MEDIA_ACCEL = config('MEDIA_ACCEL', default='')
+MEDIA_ACCEL_PREFIX = config('MEDIA_ACCEL_PREFIX', default='/protected-media/')
+
 # File upload settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
@@ -248,7 +304,24 @@ GOOGLE_OAUTH2_CLIENT_SECRET = config('GOOGLE_OAUTH2_CLIENT_SECRET', default='')
 
 # Session settings for better authentication
 SESSION_COOKIE_AGE = 86400  # 24 hours
-SESSION_SAVE_EVERY_REQUEST = True
+
+# Where sessions are kept:
+#   db             - database only, saved on every request (every poll and presence ping writes)
+#   cached_db      - read from the cache, written through to the database only when they change;
+#                    needs CACHE=redis, or a logout on one worker would not reach the others
+#   signed_cookies - in the signed cookie itself; no server-side storage at all
+# Outside db mode an unchanged session is saved again, pushing its expiry back,
+# at most once every SESSION_REFRESH_INTERVAL seconds (see SessionRefreshMiddleware).
+SESSION_MODE = config('SESSION_MODE', default='cached_db' if CACHE == 'redis' else 'db')
+if SESSION_MODE == 'cached_db' and CACHE != 'redis':
+    raise ImproperlyConfigured('SESSION_MODE=cached_db needs a cache shared by every worker (CACHE=redis).')
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}[SESSION_MODE]
+SESSION_SAVE_EVERY_REQUEST = SESSION_MODE == 'db'
+SESSION_REFRESH_INTERVAL = config('SESSION_REFRESH_INTERVAL', default=3600, cast=int)  # seconds
 SESSION_EXPIRE_AT_BROWSER_CLOSE = False
 SESSION_COOKIE_HTTPONLY = True
 
@@ -17,7 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from django.shortcuts import redirect
 from django.conf import settings
-from django.conf.urls.static import static
+from chatapp.media_views import serve_media
 
 def redirect_to_rooms(request):
     return redirect('rooms/')
@@ -27,8 +27,6 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),  # Allauth URLs
     path('rooms/', include('chatapp.urls')),
+    # Media is served through Django in every environment, so room access is always checked
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', serve_media, name='serve_media'),
 ]
-
-# Serve media files in development
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)